@@ -7,23 +7,41 @@ Copyright (c) 2019, vit9696
 """
 
 import argparse
+import array
+import asyncio
 import binascii
+import concurrent.futures
+import contextlib
+import errno
 import hashlib
+import io
 import json
 import linecache
 import os
 import random
+import shutil
+import ssl
 import struct
 import sys
+import threading
+import time
 
 try:
-    from urllib.request import Request, HTTPError, urlopen
-    from urllib.parse import urlparse
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException, IncompleteRead, RemoteDisconnected
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.request import Request, HTTPError, getproxies, proxy_bypass, urlopen
+    from urllib.parse import parse_qs, quote, unquote, urljoin, urlparse
 except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException, IncompleteRead, BadStatusLine as RemoteDisconnected
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+    from urllib import getproxies, proxy_bypass, quote, unquote
     from urllib2 import Request, HTTPError, urlopen
-    from urlparse import urlparse
+    from urlparse import parse_qs, urljoin, urlparse
 
 SELF_DIR = os.path.dirname(os.path.realpath(__file__))
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), 'macrecovery')
+
+RECOVERY_SERVER = 'http://osrecovery.apple.com'
 
 RECENT_MAC = 'Mac-7BA5B2D9E42DDD94'
 MLB_ZERO = '00000000000000000'
@@ -43,23 +61,302 @@ INFO_SIGN_HASH = 'CH'
 INFO_SIGN_SESS = 'CT'
 INFO_REQURED = [INFO_PRODUCT, INFO_IMAGE_LINK, INFO_IMAGE_HASH, INFO_IMAGE_SESS, INFO_SIGN_LINK, INFO_SIGN_HASH, INFO_SIGN_SESS]
 
+VERIFIED_NAME = '.verified.json'
+VERIFIED_LOCK = threading.Lock()
+
+PROGRESS_INTERVAL = 0.5
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Metrics:
+    """
+    Per-phase timings, transferred bytes and per-request latencies, optionally emitted as JSON lines.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.latencies = []
+        self.fh = None
+
+    def emit(self, event):
+        if self.path is None:
+            return
+        with self.lock:
+            if self.fh is None:
+                self.fh = open(self.path, 'a', encoding='utf-8')
+            self.fh.write(json.dumps(dict(event, time=time.time())) + '\n')
+            self.fh.flush()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        record = {'bytes': 0}
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                phase['count'] += 1
+                phase['seconds'] += seconds
+                phase['bytes'] += record['bytes']
+            event = {'event': 'phase', 'phase': name, 'seconds': seconds}
+            if record['bytes'] > 0:
+                event.update(bytes=record['bytes'], throughput=record['bytes'] / seconds if seconds > 0 else 0)
+            self.emit(event)
+
+    def timed(self, name, func, *args):
+        with self.phase(name):
+            return func(*args)
+
+    def request(self, url, status, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+        self.emit({'event': 'request', 'url': url, 'status': status, 'seconds': seconds})
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            phases = {name: dict(phase) for name, phase in self.phases.items()}
+        for phase in phases.values():
+            if phase['bytes'] > 0 and phase['seconds'] > 0:
+                phase['throughput'] = phase['bytes'] / phase['seconds']
+        histogram = {f'<={bucket}': sum(1 for latency in latencies if latency <= bucket) for bucket in LATENCY_BUCKETS}
+        histogram[f'>{LATENCY_BUCKETS[-1]}'] = sum(1 for latency in latencies if latency > LATENCY_BUCKETS[-1])
+        summary = {'event': 'summary', 'phases': phases, 'requests': len(latencies), 'latency_histogram': histogram}
+        if latencies:
+            summary['latency'] = {f'p{percent}': latencies[min(len(latencies) - 1, len(latencies) * percent // 100)] for percent in [50, 90, 99]}
+        return summary
+
+    def close(self):
+        self.emit(self.summary())
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+
+METRICS = Metrics()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient failures, with a per-request socket timeout.
+    """
+
+    TRANSIENT = [408, 425, 429, 500, 502, 503, 504]
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, timeout=60, hedge=0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hedge = hedge
+
+    def transient(self, err):
+        if isinstance(err, HTTPError):
+            return err.code in self.TRANSIENT
+        return isinstance(err, (HTTPException, OSError))
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+RETRY = RetryPolicy()
+
+
+class QueryError(RuntimeError):
+    pass
+
+
+class TransferError(Exception):
+    """
+    Response body failing midway, raised from the original network error. Errors writing the body out
+    are local and never wrapped, so that only the transfer itself gets retried.
+    """
+
+
+def is_proxied(url):
+    purl = urlparse(url)
+    return purl.scheme in getproxies() and not proxy_bypass(purl.hostname)
+
+
+class PooledResponse:
+    """
+    HTTP response that hands its connection back to the pool once the body has been fully read.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.close()
+        return data
+
+    def readinto(self, buffer):
+        length = self.response.readinto(buffer)
+        if self.response.isclosed():
+            self.close()
+        return length
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.response.status
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections, kept per scheme, host and port.
+    """
+
+    REDIRECTS = [301, 302, 303, 307, 308]
+
+    def __init__(self, size=16):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, key):
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        scheme, host, port = key
+        return (HTTPSConnection if scheme == 'https' else HTTPConnection)(host, port, timeout=RETRY.timeout), False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, headers, data=None):
+        purl = urlparse(url)
+        key = (purl.scheme, purl.hostname, purl.port)
+        path = purl.path or '/'
+        if purl.query:
+            path += '?' + purl.query
+        while True:
+            conn, reused = self.acquire(key)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                return PooledResponse(self, key, conn, response)
+            except (HTTPException, OSError):
+                conn.close()
+                # Idle connections may have been dropped by the server, retry those on a fresh one.
+                if not reused:
+                    raise
+
+    def urlopen(self, url, headers, data=None):
+        if is_proxied(url):
+            return urlopen(Request(url=url, headers=headers, data=data), timeout=RETRY.timeout)
+        method = 'GET' if data is None else 'POST'
+        for _ in range(10):
+            response = self.request(method, url, headers, data)
+            if response.status in self.REDIRECTS and response.getheader('Location'):
+                response.read()
+                response.close()
+                url = urljoin(url, response.getheader('Location'))
+                headers = {key: value for key, value in headers.items() if key.lower() not in ['host', 'content-type', 'content-length']}
+                if response.status in [301, 302, 303]:
+                    method, data = 'GET', None
+                continue
+            if response.status >= 400:
+                body = response.read()
+                response.close()
+                raise HTTPError(url, response.status, response.reason, response.info(), io.BytesIO(body))
+            return response
+        raise HTTPError(url, response.status, 'Too many redirects', response.info(), None)
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def query_data(post):
+    if post is None:
+        return None
+    data = '\n'.join([entry + '=' + post[entry] for entry in post])
+    if sys.version_info[0] >= 3:
+        data = data.encode('utf-8')
+    return data
+
+
+def query_failed(url, attempt, err, start):
+    """
+    Account for a failed query attempt, returning the backoff before the next one,
+    or raising QueryError once err is not transient or the attempts are used up.
+    """
+    METRICS.request(url, err.code if isinstance(err, HTTPError) else None, time.monotonic() - start)
+    if attempt == RETRY.attempts or not RETRY.transient(err):
+        raise QueryError(f'"{err}" when connecting to {url}') from err
+    METRICS.emit({'event': 'retry', 'url': url, 'attempt': attempt + 1, 'error': str(err)})
+    return RETRY.delay(attempt)
+
 
 def run_query(url, headers, post=None, raw=False):
-    if post is not None:
-        data = '\n'.join([entry + '=' + post[entry] for entry in post])
-        if sys.version_info[0] >= 3:
-            data = data.encode('utf-8')
-    else:
-        data = None
-    req = Request(url=url, headers=headers, data=data)
+    data = query_data(post)
+    for attempt in range(RETRY.attempts + 1):
+        start = time.monotonic()
+        try:
+            response = CONNECTION_POOL.urlopen(url, headers, data)
+            METRICS.request(url, response.getcode(), time.monotonic() - start)
+            if raw:
+                return response
+            try:
+                return dict(response.info()), response.read()
+            finally:
+                response.close()
+        except (HTTPException, OSError) as e:
+            time.sleep(query_failed(url, attempt, e, start))
+
+
+def hedge_started(func):
+    METRICS.emit({'event': 'hedge', 'query': func.__name__})
+
+
+def hedged(func, *args):
+    """
+    Call func, starting one duplicate call when the first one has not finished within RETRY.hedge seconds.
+    Only meant for small idempotent queries, whichever call succeeds first wins.
+    """
+    if RETRY.hedge <= 0:
+        return func(*args)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
     try:
-        response = urlopen(req)
-        if raw:
-            return response
-        return dict(response.info()), response.read()
-    except HTTPError as e:
-        print(f'ERROR: "{e}" when connecting to {url}')
-        sys.exit(1)
+        futures = [executor.submit(func, *args)]
+        if not concurrent.futures.wait(futures, timeout=RETRY.hedge)[0]:
+            hedge_started(func)
+            futures.append(executor.submit(func, *args))
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is None:
+                return future.result()
+        raise futures[0].exception()
+    finally:
+        executor.shutdown(wait=False)
 
 
 def generate_id(id_type, id_value=None):
@@ -89,6 +386,9 @@ def int_from_unsigned_bytes(byte_list, byteorder):
 # zhangyoufu https://gist.github.com/MCJack123/943eaca762730ca4b7ae460b731b68e7#gistcomment-3061078 2021-10-08
 Apple_EFI_ROM_public_key_1 = 0xC3E748CAD9CD384329E10E25A91E43E1A762FF529ADE578C935BDDF9B13F2179D4855E6FC89E9E29CA12517D17DFA1EDCE0BEBF0EA7B461FFE61D94E2BDF72C196F89ACD3536B644064014DAE25A15DB6BB0852ECBD120916318D1CCDEA3C84C92ED743FC176D0BACA920D3FCF3158AFF731F88CE0623182A8ED67E650515F75745909F07D415F55FC15A35654D118C55A462D37A3ACDA08612F3F3F6571761EFCCBCC299AEE99B3A4FD6212CCFFF5EF37A2C334E871191F7E1C31960E010A54E86FA3F62E6D6905E1CD57732410A3EB0C6B4DEFDABE9F59BF1618758C751CD56CEF851D1C0EAA1C558E37AC108DA9089863D20E2E7E4BF475EC66FE6B3EFDCF
 
+# PKCS#1 v1.5 padding and SHA-256 DigestInfo prefix expected in front of the chunklist digest.
+CHUNKLIST_SIGNATURE_PADDING = 0x1ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff003031300d0609608648016503040201050004200000000000000000000000000000000000000000000000000000000000000000
+
 ChunkListHeader = struct.Struct('<4sIBBBxQQQ')
 assert ChunkListHeader.size == 0x24
 
@@ -96,12 +396,14 @@ Chunk = struct.Struct('<I32s')
 assert Chunk.size == 0x24
 
 
-def verify_chunklist(cnkpath):
-    with open(cnkpath, 'rb') as f:
-        hash_ctx = hashlib.sha256()
-        data = f.read(ChunkListHeader.size)
-        hash_ctx.update(data)
-        magic, header_size, file_version, chunk_method, signature_method, chunk_count, chunk_offset, signature_offset = ChunkListHeader.unpack(data)
+class ChunkList:
+    """
+    Parsed chunklist keeping chunk sizes, hashes and cumulative offsets in compact arrays.
+    The signature is checked once when parsing.
+    """
+
+    def __init__(self, data):
+        magic, header_size, file_version, chunk_method, signature_method, chunk_count, chunk_offset, signature_offset = ChunkListHeader.unpack_from(data)
         assert magic == b'CNKL'
         assert header_size == ChunkListHeader.size
         assert file_version == 1
@@ -110,37 +412,245 @@ def verify_chunklist(cnkpath):
         assert chunk_count > 0
         assert chunk_offset == 0x24
         assert signature_offset == chunk_offset + Chunk.size * chunk_count
-        for _ in range(chunk_count):
-            data = f.read(Chunk.size)
-            hash_ctx.update(data)
-            chunk_size, chunk_sha256 = Chunk.unpack(data)
-            yield chunk_size, chunk_sha256
-        digest = hash_ctx.digest()
+        assert len(data) >= signature_offset
+        digest = hashlib.sha256(data[:signature_offset]).digest()
         if signature_method == 1:
-            data = f.read(256)
-            assert len(data) == 256
-            signature = int_from_unsigned_bytes(data, 'little')
-            plaintext = 0x1ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff003031300d0609608648016503040201050004200000000000000000000000000000000000000000000000000000000000000000 | int_from_unsigned_bytes(digest, 'big')
+            assert len(data) == signature_offset + 256
+            signature = int_from_unsigned_bytes(data[signature_offset:], 'little')
+            plaintext = CHUNKLIST_SIGNATURE_PADDING | int_from_unsigned_bytes(digest, 'big')
             assert pow(signature, 0x10001, Apple_EFI_ROM_public_key_1) == plaintext
         elif signature_method == 2:
-            data = f.read(32)
-            assert data == digest
+            assert data[signature_offset:signature_offset + 32] == digest
             raise RuntimeError('Chunklist missing digital signature')
         else:
             raise NotImplementedError
-        assert f.read(1) == b''
+
+        entries = data[chunk_offset:signature_offset]
+        self.sizes = array.array('L', (chunk_size for chunk_size, _ in Chunk.iter_unpack(entries)))
+        self.hashes = b''.join(chunk_sha256 for _, chunk_sha256 in Chunk.iter_unpack(entries))
+        self.offsets = array.array('Q', [0])
+        for chunk_size in self.sizes:
+            self.offsets.append(self.offsets[-1] + chunk_size)
+
+    @classmethod
+    def load(cls, cnkpath):
+        with open(cnkpath, 'rb') as f:
+            return cls(f.read())
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.sizes):
+            raise IndexError('Chunk index out of range')
+        return self.sizes[index], self.hashes[index * 32:index * 32 + 32]
+
+    def __iter__(self):
+        for index in range(len(self.sizes)):
+            yield self[index]
+
+    @property
+    def size(self):
+        return self.offsets[-1]
+
+    def offset(self, index):
+        return self.offsets[index]
+
+
+def verify_chunklist(cnkpath):
+    yield from ChunkList.load(cnkpath)
+
+
+class QueryCache:
+    """
+    TTL cache of session cookies and image info with size-bounded eviction, optionally persisted to a JSON file.
+    Concurrent lookups of the same key are coalesced into a single query.
+    """
+
+    def __init__(self, path=None, ttl=0, size=0):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = {}
+        self.tasks = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.dirty = False
+        self.loaded = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                self.entries = json.load(fh)
+        except (OSError, ValueError):
+            self.entries = {}
+        with self.lock:
+            self.evict()
+            self.loaded = {key: value for key, (_, value) in self.entries.items()}
+
+    def stale(self, key, value):
+        """
+        Check whether value was cached for key by an earlier run rather than queried by this one.
+        """
+        return key in self.loaded and self.loaded[key] == value
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            self.evict()
+            data = json.dumps(self.entries)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmppath = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as fh:
+            fh.write(data)
+        os.replace(tmppath, self.path)
+
+    def evict(self):
+        now = time.time()
+        for key in [key for key, (stamp, _) in self.entries.items() if now - stamp >= self.ttl]:
+            del self.entries[key]
+        if len(self.entries) > self.size:
+            for key in sorted(self.entries, key=lambda key: self.entries[key][0])[:len(self.entries) - self.size]:
+                del self.entries[key]
+
+    def forget(self, key, value=None):
+        with self.lock:
+            # Given a value, only drop it if nobody replaced it in the meantime.
+            if value is None or self.entries.get(key, [None, value])[1] == value:
+                self.entries.pop(key, None)
+
+    async def afetch(self, key, query):
+        """
+        Coroutine variant of fetch, coalescing lookups within the running event loop.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            task = self.tasks.get(key)
+            if task is None:
+                task = self.tasks[key] = asyncio.ensure_future(self.afill(key, query))
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def afill(self, key, query):
+        try:
+            value = await query()
+            with self.lock:
+                self.entries[key] = [time.time(), value]
+                self.evict()
+                self.dirty = True
+            return value
+        finally:
+            with self.lock:
+                del self.tasks[key]
+
+    def fetch(self, key, query):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            # Pending lookups are [done event, value, exception] shared with coalesced callers.
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.pending[key] = [threading.Event(), None, None]
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending[0].wait()
+            if pending[2] is not None:
+                raise pending[2]
+            return pending[1]
+
+        try:
+            pending[1] = query()
+            with self.lock:
+                self.entries[key] = [time.time(), pending[1]]
+                self.evict()
+                self.dirty = True
+            return pending[1]
+        except BaseException as e:
+            pending[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending[0].set()
+
+
+QUERY_CACHE = QueryCache()
 
 
 def get_session(args):
+    return QUERY_CACHE.fetch('session', lambda: METRICS.timed('session', query_session, args))
+
+
+def renew_session(args, session):
+    """
+    Replace a session cached by an earlier run, which the server may no longer accept, returning the
+    new session, or None when session was queried by this run and renewing it would not help.
+    """
+    if not QUERY_CACHE.stale('session', session):
+        return None
+    QUERY_CACHE.forget('session', session)
+    return get_session(args)
+
+
+def session_image_info(args, bid, mlb=MLB_ZERO, diag=False, os_type='default'):
+    """
+    Query image info with the cached session, renewing it once if the server rejects it.
+    """
+    session = get_session(args)
+    try:
+        return get_image_info(session, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+    except QueryError:
+        session = renew_session(args, session)
+        if session is None:
+            raise
+        return get_image_info(session, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+
+
+def asset_image_info(args, bid, mlb=MLB_ZERO, diag=False, os_type='default'):
+    """
+    Query image info for downloading its assets. The asset tokens in info cached by an earlier run
+    may have expired, so such info is queried again.
+    """
+    info = session_image_info(args, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+    key = image_info_key(bid, mlb, os_type, diag)
+    if not QUERY_CACHE.stale(key, info):
+        return info
+    QUERY_CACHE.forget(key, info)
+    return session_image_info(args, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+
+
+def query_session(args):
+    headers, _ = run_query(*session_query())
+    return parse_session(headers, args.verbose)
+
+
+def session_query():
     headers = {
         'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
+        'Connection': 'keep-alive',
         'User-Agent': 'InternetRecovery/1.0',
     }
 
-    headers, _ = run_query('http://osrecovery.apple.com/', headers)
+    return RECOVERY_SERVER + '/', headers
 
-    if args.verbose:
+
+def parse_session(headers, verbose=False):
+    if verbose:
         print('Session headers:')
         for header in headers:
             print(f'{header}: {headers[header]}')
@@ -154,10 +664,24 @@ def get_session(args):
     raise RuntimeError('No session in headers ' + str(headers))
 
 
+def image_info_key(bid, mlb, os_type, diag):
+    return json.dumps(['info', bid, mlb, os_type, diag])
+
+
 def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+    key = image_info_key(bid, mlb, os_type, diag)
+    return dict(QUERY_CACHE.fetch(key, lambda: METRICS.timed('info', hedged, query_image_info, session, bid, mlb, diag, os_type, cid)))
+
+
+def query_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+    _, output = run_query(*image_info_query(session, bid, mlb, diag, os_type, cid))
+    return parse_image_info(output)
+
+
+def image_info_query(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
     headers = {
         'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
+        'Connection': 'keep-alive',
         'User-Agent': 'InternetRecovery/1.0',
         'Cookie': session,
         'Content-Type': 'text/plain',
@@ -172,13 +696,15 @@ def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', ci
     }
 
     if diag:
-        url = 'http://osrecovery.apple.com/InstallationPayload/Diagnostics'
+        url = RECOVERY_SERVER + '/InstallationPayload/Diagnostics'
     else:
-        url = 'http://osrecovery.apple.com/InstallationPayload/RecoveryImage'
+        url = RECOVERY_SERVER + '/InstallationPayload/RecoveryImage'
         post['os'] = os_type
 
-    headers, output = run_query(url, headers, post)
+    return url, headers, post
+
 
+def parse_image_info(output):
     output = output.decode('utf-8')
     info = {}
     for line in output.split('\n'):
@@ -195,58 +721,811 @@ def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', ci
     return info
 
 
-def save_image(url, sess, filename='', directory=''):
-    purl = urlparse(url)
-    headers = {
-        'Host': purl.hostname,
-        'Connection': 'close',
+class ChunkStore:
+    """
+    Content-addressed store of verified image chunks keyed by SHA-256, evicting least recently used chunks over budget.
+    """
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+
+    def path(self, cnkhash):
+        name = binascii.hexlify(cnkhash).decode('ascii')
+        return os.path.join(self.directory, name[:2], name)
+
+    def load(self, cnksize, cnkhash):
+        path = self.path(cnkhash)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read(cnksize + 1)
+            if len(data) != cnksize or hashlib.sha256(data).digest() != cnkhash:
+                os.remove(path)
+                return None
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def save(self, cnkhash, data):
+        path = self.path(cnkhash)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmppath, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmppath, path)
+
+    def assemble(self, path, chunks, present):
+        present = list(present)
+        offset = 0
+        with open(path, 'r+b') as fh:
+            for index, (cnksize, cnkhash) in enumerate(chunks):
+                if not present[index]:
+                    data = self.load(cnksize, cnkhash)
+                    if data is not None:
+                        fh.seek(offset)
+                        fh.write(data)
+                        present[index] = True
+                offset += cnksize
+        return present
+
+    def evict(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class ChunkVerifier:
+    """
+    Incrementally hash streamed image data against chunklist entries first..stop, saving verified chunks to store.
+    """
+
+    def __init__(self, chunks, first=0, stop=None, store=None):
+        self.chunks = chunks
+        self.index = first
+        self.stop = len(chunks) if stop is None else stop
+        self.offset = 0
+        self.hash_ctx = hashlib.sha256()
+        self.store = store
+        self.buffer = bytearray()
+
+    def update(self, data):
+        view = memoryview(data)
+        while True:
+            if self.index >= self.stop:
+                if len(view) > 0:
+                    raise RuntimeError('Invalid image: larger than chunklist')
+                return
+            cnksize, cnkhash = self.chunks[self.index]
+            length = min(len(view), cnksize - self.offset)
+            self.hash_ctx.update(view[:length])
+            if self.store is not None:
+                self.buffer += view[:length]
+            self.offset += length
+            view = view[length:]
+            if self.offset < cnksize:
+                return
+            if self.hash_ctx.digest() != cnkhash:
+                raise RuntimeError(f'Invalid chunk {self.index + 1}: hash mismatch')
+            if self.store is not None:
+                self.store.save(cnkhash, self.buffer)
+                self.buffer = bytearray()
+            self.index += 1
+            self.offset = 0
+            self.hash_ctx = hashlib.sha256()
+
+    def finish(self):
+        if self.index < self.stop:
+            cnksize, _ = self.chunks[self.index]
+            raise RuntimeError(f'Invalid chunk {self.index + 1} size: expected {cnksize}, read {self.offset}')
+
+
+class ChunkStream:
+    """
+    Write-only file object passing streamed image data on to out one verified chunk at a time, so that
+    nothing unverified is ever written and no more than one chunk is held in memory.
+    """
+
+    def __init__(self, out, chunks, store=None):
+        self.out = out
+        self.store = store
+        self.position = 0
+        # Verified chunks are handed to save below, as they would be to a chunk store.
+        self.verifier = ChunkVerifier(chunks, store=self)
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.verifier.update(data)
+        self.position += len(data)
+
+    def save(self, cnkhash, data):
+        self.out.write(data)
+        if self.store is not None:
+            self.store.save(cnkhash, data)
+
+    def finish(self):
+        self.verifier.finish()
+        self.out.flush()
+
+
+class RateLimiter:
+    """
+    Space out calls so that no more than rate calls (or cost units) per second start, unlimited when rate is zero.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def reserve(self, cost=1):
+        """
+        Book the next slot, returning how many seconds to wait before using it.
+        """
+        if self.interval == 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval * cost
+        return max(0, delay)
+
+    def wait(self, cost=1):
+        delay = self.reserve(cost)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Download bandwidth in bytes per second shared by every transfer.
+BANDWIDTH = RateLimiter(0)
+
+
+class Progress:
+    """
+    Thread-safe download byte counter printing a progress line at most once per interval.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.total = 0
+        self.shown = 0.0
+
+    def due(self):
+        now = time.monotonic()
+        if now - self.shown < self.interval:
+            return False
+        self.shown = now
+        return True
+
+    def __call__(self, length):
+        with self.lock:
+            self.total += length
+            if self.due():
+                print(f'\r{self.total / (2**20)} MBs downloaded...', end='')
+                sys.stdout.flush()
+
+
+class BlockSizer:
+    """
+    Adapt the read size so that a single read takes about target seconds at the observed throughput:
+    small blocks keep slow links responsive, large ones save per-read overhead on fast links.
+    """
+
+    MIN_SIZE = 2**16
+    MAX_SIZE = 2**20
+
+    def __init__(self, target=0.02):
+        self.target = target
+        self.size = 2**18
+
+    def update(self, length, seconds):
+        ideal = length / seconds * self.target if seconds > 0 else self.MAX_SIZE
+        if length == self.size and ideal > self.size * 2:
+            self.size = min(self.MAX_SIZE, self.size * 2)
+        elif ideal < self.size / 2:
+            self.size = max(self.MIN_SIZE, self.size // 2)
+
+
+def preallocate(fh, size):
+    """
+    Size the file and, where supported, reserve its disk space up front to avoid fragmentation
+    and running out of space half way through.
+    """
+    fh.truncate(size)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fh.fileno(), 0, size)
+        except OSError as e:
+            # Not every file system supports it, the file is just sparse then.
+            if e.errno not in [errno.EOPNOTSUPP, errno.EINVAL]:
+                raise
+
+
+def write_block(fh, verifier, block):
+    if verifier is not None:
+        verifier.update(block)
+    fh.write(block)
+
+
+def stream_response(response, fh, progress, verifier=None, length=None, abort=None):
+    sizer = BlockSizer()
+    buffer = memoryview(bytearray(sizer.size))
+    received = 0
+    while length is None or received < length:
+        if abort is not None and abort.is_set():
+            break
+        if len(buffer) < sizer.size:
+            buffer = memoryview(bytearray(sizer.size))
+        start = time.monotonic()
+        # Read straight into the reused buffer, the block is consumed before the next read.
+        try:
+            read = response.readinto(buffer[:sizer.size if length is None else min(sizer.size, length - received)])
+        except (HTTPException, OSError) as e:
+            raise TransferError(e) from e
+        if not read:
+            break
+        sizer.update(read, time.monotonic() - start)
+        write_block(fh, verifier, buffer[:read])
+        received += read
+        progress(read)
+        BANDWIDTH.wait(read)
+    return received
+
+
+def range_size(status, content_range):
+    """
+    Return the image size announced in reply to a bytes=0-0 probe, None when ranges are not supported.
+    """
+    if status != 206 or not content_range.startswith('bytes 0-0/'):
+        return None
+    try:
+        return int(content_range.split('/')[1])
+    except ValueError:
+        return None
+
+
+def query_size(url, headers):
+    response = run_query(url, dict(headers, Range='bytes=0-0'), raw=True)
+    try:
+        size = range_size(response.getcode(), response.info().get('Content-Range', ''))
+        if size is not None:
+            try:
+                response.read()
+            except (HTTPException, OSError):
+                # Only the header matters, a broken body just costs the connection.
+                pass
+        return size
+    finally:
+        response.close()
+
+
+class ResumableTransfer:
+    """
+    Range and retry bookkeeping for streaming url into fh from its current position up to end, or the end
+    of the response when end is None. A transfer failing midway continues with a range request from the
+    last byte written, so nothing already received is fetched or verified again.
+    """
+
+    def __init__(self, url, headers, fh, end=None, abort=None):
+        self.url = url
+        self.headers = headers
+        self.fh = fh
+        self.end = end
+        self.abort = abort
+        self.start = self.offset = fh.tell()
+        self.ranged = False
+        self.failures = 0
+
+    @property
+    def received(self):
+        return self.fh.tell() - self.start
+
+    def aborted(self):
+        return self.abort is not None and self.abort.is_set()
+
+    def request_headers(self):
+        self.ranged = self.end is not None or self.offset > self.start
+        if not self.ranged:
+            return self.headers
+        return dict(self.headers, Range=f'bytes={self.offset}-{"" if self.end is None else self.end - 1}')
+
+    def accept(self, status, length, content_range=''):
+        """
+        Check the response status, range and announced length, returning the number of bytes to read, None for all.
+        """
+        if self.ranged and status != 206:
+            raise RuntimeError(f'Server ignored range request for bytes {self.offset}-{"" if self.end is None else self.end - 1}')
+        if self.ranged and not content_range.startswith(f'bytes {self.offset}-'):
+            raise RuntimeError(f'Server answered range request for bytes {self.offset}- with {content_range or "no range"}')
+        if self.end is None and length:
+            # Connections closed early just end the body, so tell truncation by the announced length,
+            # which a ranged reply counts from the offset it resumes at.
+            self.end = self.offset + int(length)
+            if isinstance(self.fh, io.IOBase) and self.fh.seekable():
+                preallocate(self.fh, self.end)
+        return None if self.end is None else self.end - self.offset
+
+    def complete(self):
+        return self.aborted() or self.end is None or self.fh.tell() == self.end
+
+    def failed(self, err):
+        """
+        Account for err, a TransferError or truncation, returning the backoff before continuing,
+        or raising the underlying error once aborted or out of retries.
+        """
+        if isinstance(err, TransferError):
+            err = err.__cause__
+        # Only consecutive failures without any progress count against the retry budget.
+        self.failures = self.failures + 1 if self.fh.tell() == self.offset else 1
+        if self.aborted() or self.failures > RETRY.attempts:
+            raise err
+        self.offset = self.fh.tell()
+        METRICS.emit({'event': 'retry', 'url': self.url, 'offset': self.offset, 'error': str(err)})
+        return RETRY.delay(self.failures - 1)
+
+
+def stream_resumable(url, headers, fh, progress, verifier=None, end=None, abort=None):
+    """
+    Stream url into fh as a ResumableTransfer, returning the number of bytes received.
+    """
+    transfer = ResumableTransfer(url, headers, fh, end, abort)
+    while True:
+        try:
+            response = run_query(url, transfer.request_headers(), raw=True)
+            try:
+                length = transfer.accept(response.getcode(), response.info().get('Content-Length'), response.info().get('Content-Range', ''))
+                stream_response(response, fh, progress, verifier, length, abort)
+            finally:
+                response.close()
+            if transfer.complete():
+                return transfer.received
+            err = HTTPException(f'Transfer truncated at byte {fh.tell()}')
+        except TransferError as e:
+            err = e
+        time.sleep(transfer.failed(err))
+
+
+def save_segment(url, headers, path, segment, progress, chunks=None, abort=None, store=None):
+    start, end, first, stop = segment
+    try:
+        verifier = ChunkVerifier(chunks, first, stop, store) if chunks is not None else None
+        with open(path, 'r+b') as fh:
+            fh.seek(start)
+            stream_resumable(url, headers, fh, progress, verifier, end, abort)
+        if abort is not None and abort.is_set():
+            return
+        if verifier is not None:
+            verifier.finish()
+    except BaseException:
+        if abort is not None:
+            abort.set()
+        raise
+
+
+class ChunkReader:
+    """
+    Read image chunks into one reusable buffer per thread, so that hashing never holds more than
+    a chunk per thread in memory, unlike mapping the whole image.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def hash_chunk(self, offset, cnksize, cnkhash):
+        local = self.local
+        if not hasattr(local, 'fh'):
+            local.fh = open(self.path, 'rb', buffering=0)
+            local.buffer = bytearray()
+            with self.lock:
+                self.handles.append(local.fh)
+        if len(local.buffer) < cnksize:
+            local.buffer = bytearray(cnksize)
+        view = memoryview(local.buffer)[:cnksize]
+        local.fh.seek(offset)
+        length = 0
+        while length < cnksize:
+            read = local.fh.readinto(view[length:])
+            if not read:
+                break
+            length += read
+        return length, hashlib.sha256(view[:length]).digest() == cnkhash
+
+    def close(self):
+        with self.lock:
+            for fh in self.handles:
+                fh.close()
+            self.handles = []
+
+
+def hash_chunks(dmgpath, chunks, jobs=1, indices=None):
+    """
+    Yield (read size, hash match) for chunklist entries in order, hashing the image on a thread pool.
+    """
+    reader = ChunkReader(dmgpath)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = []
+        for index in range(len(chunks)) if indices is None else indices:
+            cnksize, cnkhash = chunks[index]
+            futures.append(executor.submit(reader.hash_chunk, chunks.offset(index), cnksize, cnkhash))
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        reader.close()
+
+
+def verified_chunks(path, chunks, jobs=1):
+    return [length == cnksize and valid for (cnksize, _), (length, valid) in zip(chunks, hash_chunks(path, chunks, jobs))]
+
+
+def split_segments(size, segments, chunks=None, present=None):
+    """
+    Split image into (start, end, first chunk, stop chunk) slices, aligned to chunk boundaries when possible.
+    Chunks marked as present are left out of the slices.
+    """
+    if chunks is None:
+        step = -(-size // segments)
+        return [(start, min(start + step, size), None, None) for start in range(0, size, step)]
+
+    if present is None:
+        present = [False] * len(chunks)
+    missing = sum(cnksize for (cnksize, _), valid in zip(chunks, present) if not valid)
+    step = max(1, -(-missing // segments))
+
+    result = []
+    start = first = None
+    offset = 0
+    for index, (cnksize, _) in enumerate(chunks):
+        if present[index]:
+            if first is not None:
+                result.append((start, offset, first, index))
+                first = None
+            offset += cnksize
+            continue
+        if first is None:
+            start, first = offset, index
+        offset += cnksize
+        if offset - start >= step:
+            result.append((start, offset, first, index + 1))
+            first = None
+    if first is not None:
+        result.append((start, offset, first, len(chunks)))
+    return result
+
+
+def save_segmented(url, headers, path, size, parts, workers, progress, chunks=None, resume=False, store=None):
+    abort = threading.Event()
+    allocate_image(path, size, resume)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(save_segment, url, headers, path, part, progress, chunks, abort, store)
+                   for part in parts]
+        concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        abort.set()
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+
+def save_image(url, sess, filename='', directory='', segments=1, chunks=None, resume=False, store=None, jobs=1):
+    with METRICS.phase('download') as record:
+        progress = Progress()
+        try:
+            return fetch_image(url, sess, filename, directory, progress, segments, chunks, resume, store, jobs)
+        finally:
+            record['bytes'] = progress.total
+
+
+def fetch_image(url, sess, filename, directory, progress, segments=1, chunks=None, resume=False, store=None, jobs=1):
+    path, headers, parts = prepare_image(url, sess, filename, directory, segments, chunks, resume, store, jobs)
+    if parts == []:
+        return path
+
+    size = query_size(url, headers) if wants_ranges(segments, parts) else None
+    slices = image_slices(size, segments, chunks, parts)
+    if slices is not None:
+        save_segmented(url, headers, path, size, slices, min(segments, size), progress, chunks, parts is not None, store)
+    else:
+        with open(path, 'wb') as fh:
+            verifier = ChunkVerifier(chunks, store=store) if chunks is not None else None
+            stream_resumable(url, headers, fh, progress, verifier)
+            if verifier is not None:
+                verifier.finish()
+    print('\rDownload complete!\t\t\t\t\t')
+    return path
+
+
+def wants_ranges(segments, parts):
+    return segments > 1 or parts is not None
+
+
+def image_slices(size, segments, chunks=None, parts=None):
+    """
+    Return the slices still to fetch with HTTP Range requests given the image size reported for them,
+    or None to stream the whole image at once when the server does not support range requests.
+    """
+    expected = chunks.size if chunks is not None else size
+    if size and size != expected:
+        raise RuntimeError(f'Invalid image size: expected {expected}, server reports {size}')
+    if size:
+        return parts or split_segments(size, min(segments, size), chunks)
+
+    if parts is not None:
+        print('WARN: Server does not support range requests, restarting download')
+    elif segments > 1:
+        print('WARN: Server does not support range requests, using single stream')
+    return None
+
+
+def allocate_image(path, size, resume=False):
+    with open(path, 'r+b' if resume else 'wb') as fh:
+        preallocate(fh, size)
+
+
+def asset_headers(url, sess):
+    return {
+        'Host': urlparse(url).hostname,
+        'Connection': 'keep-alive',
         'User-Agent': 'InternetRecovery/1.0',
         'Cookie': '='.join(['AssetToken', sess])
     }
 
-    if not os.path.exists(directory):
-        os.mkdir(directory)
 
+def artifact_path(url, filename, directory):
     if filename == '':
-        filename = os.path.basename(purl.path)
+        filename = os.path.basename(urlparse(url).path)
     if filename.find('/') >= 0 or filename == '':
         raise RuntimeError('Invalid save path ' + filename)
+    return os.path.join(directory, filename)
 
-    print(f'Saving {url} to {directory}/{filename}...')
 
-    with open(os.path.join(directory, filename), 'wb') as fh:
-        response = run_query(url, headers, raw=True)
-        size = 0
-        while True:
-            chunk = response.read(2**20)
-            if not chunk:
-                break
-            fh.write(chunk)
-            size += len(chunk)
-            print(f'\r{size / (2**20)} MBs downloaded...', end='')
-            sys.stdout.flush()
-        print('\rDownload complete!\t\t\t\t\t')
+def prepare_image(url, sess, filename, directory, segments=1, chunks=None, resume=False, store=None, jobs=1):
+    """
+    Return save path, request headers and the image parts still to download, which are None when
+    starting from scratch and empty once every chunk is already present in the file or chunk store.
+    """
+    headers = asset_headers(url, sess)
+
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    path = artifact_path(url, filename, directory)
+    print(f'Saving {url} to {directory}/{os.path.basename(path)}...')
+
+    parts = None
+    resume = resume and os.path.exists(path)
+    if chunks is not None and (resume or store is not None):
+        # Keep every chunk of the partial file that already matches the chunklist,
+        # and take any other chunk held by the chunk store.
+        present = verified_chunks(path, chunks, jobs) if resume else [False] * len(chunks)
+        if store is not None:
+            if not resume:
+                open(path, 'wb').close()
+            present = store.assemble(path, chunks, present)
+        print(f'Found {sum(present)} of {len(chunks)} chunks already verified')
+        parts = split_segments(None, segments, chunks, present)
+        if not parts:
+            with open(path, 'r+b') as fh:
+                fh.truncate(chunks.size)
+            print('Download complete!')
+
+    return path, headers, parts
+
+
+def stream_image(url, sess, out, chunks, store=None):
+    with METRICS.phase('download') as record:
+        progress = Progress()
+        try:
+            sink = ChunkStream(out, chunks, store)
+            stream_resumable(url, asset_headers(url, sess), sink, progress)
+            sink.finish()
+            print('\rDownload complete!\t\t\t\t\t')
+        finally:
+            record['bytes'] = progress.total
+
+
+def mirror_url(mirror, product, url):
+    name = os.path.basename(urlparse(url).path)
+    return f'{mirror.rstrip("/")}/{quote(product)}/{quote(name)}?origin={quote(url, safe="")}'
+
+
+def chunklist_check(info):
+    """
+    Return a check that a mirrored chunklist is the one of info, as any mirror client may have filled
+    the product with another product's validly signed chunklist.
+    """
+
+    def check(path):
+        with open(path, 'rb') as fh:
+            digest = hashlib.sha256(fh.read()).hexdigest().upper()
+        if digest != info[INFO_SIGN_HASH].upper():
+            raise RuntimeError(f'Chunklist does not match {info[INFO_PRODUCT]}')
+        ChunkList.load(path)
+
+    return check
+
+
+def save_mirrored(mirror, product, url, sess, filename, directory, check=None, **kwargs):
+    """
+    Save artifact through a LAN mirror when one is given, falling back to origin if the mirror fails.
+    """
+    if mirror != '':
+        try:
+            path = save_image(mirror_url(mirror, product, url), sess, filename, directory, **kwargs)
+            if check is not None:
+                check(path)
+            return path
+        except Exception as err:
+            print(f'\rWARN: Mirror failed ({verification_error(err)}), falling back to {url}')
+            # Keep whatever the mirror delivered that still verifies.
+            kwargs['resume'] = kwargs.get('chunks') is not None
+    return save_image(url, sess, filename, directory, **kwargs)
 
-    return os.path.join(directory, os.path.basename(filename))
 
+def verify_image(dmgpath, cnkpath, jobs=1, sample=0):
+    with METRICS.phase('verify') as record:
+        check_image(dmgpath, cnkpath, jobs, sample, record)
 
-def verify_image(dmgpath, cnkpath):
+
+def check_image(dmgpath, cnkpath, jobs, sample, record):
     print('Verifying image with chunklist...')
 
-    with open(dmgpath, 'rb') as dmgf:
-        cnkcount = 0
-        for cnksize, cnkhash in verify_chunklist(cnkpath):
-            cnkcount += 1
+    progress = Progress()
+    chunks = ChunkList.load(cnkpath)
+    indices = range(len(chunks))
+    if 0 < sample < len(chunks):
+        # Spot-check a random subset of chunks, but make sure the image size is right first.
+        size = os.path.getsize(dmgpath)
+        if size != chunks.size:
+            raise RuntimeError(f'Invalid image size: expected {chunks.size}, read {size}')
+        indices = sorted(random.sample(indices, sample))
+        print(f'Checking {sample} of {len(chunks)} chunks...')
+    results = hash_chunks(dmgpath, chunks, jobs, indices)
+    # Results arrive in chunklist order, so the first failing chunk is always the one reported.
+    for cnkcount, (length, valid) in zip((index + 1 for index in indices), results):
+        cnksize, _ = chunks[cnkcount - 1]
+        record['bytes'] += length
+        if progress.due():
             print(f'\rChunk {cnkcount} ({cnksize} bytes)', end='')
             sys.stdout.flush()
-            cnk = dmgf.read(cnksize)
-            if len(cnk) != cnksize:
-                raise RuntimeError(f'Invalid chunk {cnkcount} size: expected {cnksize}, read {len(cnk)}')
-            if hashlib.sha256(cnk).digest() != cnkhash:
-                raise RuntimeError(f'Invalid chunk {cnkcount}: hash mismatch')
-        if dmgf.read(1) != b'':
-            raise RuntimeError('Invalid image: larger than chunklist')
-        print('\rImage verification complete!\t\t\t\t\t')
+        if length != cnksize:
+            results.close()
+            raise RuntimeError(f'Invalid chunk {cnkcount} size: expected {cnksize}, read {length}')
+        if not valid:
+            results.close()
+            raise RuntimeError(f'Invalid chunk {cnkcount}: hash mismatch')
+    if os.path.getsize(dmgpath) > chunks.size:
+        raise RuntimeError('Invalid image: larger than chunklist')
+    print('\rImage verification complete!\t\t\t\t\t')
+
+
+def verification_error(err):
+    if isinstance(err, AssertionError) and str(err) == '':
+        try:
+            tb = sys.exc_info()[2]
+            while tb.tb_next:
+                tb = tb.tb_next
+            return linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
+        except Exception:
+            return "Invalid chunklist"
+    return err
+
+
+def artifact_state(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
+def load_verified(directory):
+    try:
+        with open(os.path.join(directory, VERIFIED_NAME), 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def verified_entry(info, cnkpath, dmgpath):
+    with open(cnkpath, 'rb') as fh:
+        digest = hashlib.sha256(fh.read()).hexdigest().upper()
+    return {
+        'product': info[INFO_PRODUCT],
+        'image_hash': info[INFO_IMAGE_HASH],
+        'sign_hash': info[INFO_SIGN_HASH],
+        'chunklist': dict(artifact_state(cnkpath), digest=digest),
+        'image': artifact_state(dmgpath),
+        'result': 'verified',
+    }
+
+
+def is_verified(info, paths):
+    """
+    Check whether chunklist and image were verified by an earlier run against the same remote
+    product and have not been touched since.
+    """
+    cnkpath, dmgpath = paths
+    entry = load_verified(os.path.dirname(dmgpath)).get(os.path.basename(dmgpath))
+    try:
+        return entry is not None and entry == verified_entry(info, cnkpath, dmgpath)
+    except OSError:
+        return False
+
+
+def record_verified(info, paths, verified=True):
+    """
+    Record verified chunklist and image in the manifest next to them, or forget them when verification failed.
+    """
+    cnkpath, dmgpath = paths
+    directory = os.path.dirname(dmgpath)
+    with VERIFIED_LOCK:
+        entries = load_verified(directory)
+        if verified:
+            entries[os.path.basename(dmgpath)] = verified_entry(info, cnkpath, dmgpath)
+        elif entries.pop(os.path.basename(dmgpath), None) is None:
+            return
+        path = os.path.join(directory, VERIFIED_NAME)
+        tmppath = f'{path}.{os.getpid()}.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as fh:
+            json.dump(entries, fh, indent=2)
+        os.replace(tmppath, path)
+
+
+def open_chunk_store(args):
+    return ChunkStore(args.chunk_store, args.chunk_store_size * 2**20) if args.chunk_store else None
+
+
+def skip_verified(args, info, outdir):
+    """
+    Return True, after saying so, when outdir holds the artifacts of info verified and unchanged.
+    """
+    if args.force or not is_verified(info, artifact_paths(args, info, outdir)):
+        return False
+    print(f'Found {info[INFO_PRODUCT]} already verified in {outdir}, skipping download')
+    return True
+
+
+def download_done(info, paths, store=None, err=None):
+    """
+    Report the download of info into paths, recording its verification result, and return the exit code.
+    Must be called from the except block handling err, if any.
+    """
+    if err is not None:
+        print(f'\rImage verification failed. ({verification_error(err)})')
+        record_verified(info, paths, False)
+        return 1
+    if store is not None:
+        store.evict()
+    record_verified(info, paths)
+    print('Image verification complete!')
+    return 0
+
+
+def artifact_paths(args, info, outdir):
+    return [artifact_path(info[INFO_SIGN_LINK], artifact_name(args, '.chunklist'), outdir),
+            artifact_path(info[INFO_IMAGE_LINK], artifact_name(args, '.dmg'), outdir)]
 
 
 def action_download(args):
@@ -277,28 +1556,202 @@ def action_download(args):
     fg=B2E6AA07DB9088BE5BDB38DB2EA824FDDFB6C3AC5272203B32D89F9D8E3528DC
     """
 
-    session = get_session(args)
-    info = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
+    if args.output != '':
+        return stream_download(args)
+
+    info = asset_image_info(args, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
     if args.verbose:
         print(info)
+    if skip_verified(args, info, args.outdir):
+        return 0
     print(f'Downloading {info[INFO_PRODUCT]}...')
-    dmgname = '' if args.basename == '' else args.basename + '.dmg'
-    dmgpath = save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, args.outdir)
-    cnkname = '' if args.basename == '' else args.basename + '.chunklist'
-    cnkpath = save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], cnkname, args.outdir)
+    paths = artifact_paths(args, info, args.outdir)
+    cnkpath = save_mirrored(args.mirror, info[INFO_PRODUCT], info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], artifact_name(args, '.chunklist'), args.outdir, chunklist_check(info))
     try:
-        verify_image(dmgpath, cnkpath)
-        return 0
+        store = open_chunk_store(args)
+        download_image(args, info, args.outdir, cnkpath, store)
+        return download_done(info, paths, store)
     except Exception as err:
-        if isinstance(err, AssertionError) and str(err) == '':
+        return download_done(info, paths, err=err)
+
+
+def stream_download(args):
+    """
+    Download the image straight into --output, which is - for stdout, a pipe or a device, with no copy
+    in outdir. The chunklist is only kept in memory, and status lines go to stderr so that stdout carries
+    nothing but verified image data. The stream stops at the first chunk that fails verification.
+    """
+    out = sys.stdout.buffer if args.output == '-' else None
+    with contextlib.redirect_stdout(sys.stderr):
+        info = asset_image_info(args, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
+        if args.verbose:
+            print(info)
+        print(f'Streaming {info[INFO_PRODUCT]} to {"stdout" if out is not None else args.output}...')
+        _, data = run_query(info[INFO_SIGN_LINK], asset_headers(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS]))
+        try:
+            chunks = ChunkList(data)
+            store = open_chunk_store(args)
+            with (open(args.output, 'wb') if out is None else contextlib.nullcontext(out)) as fh:
+                stream_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], fh, chunks, store)
+            if store is not None:
+                store.evict()
+            print('Image verification complete!')
+            return 0
+        except Exception as err:
+            print(f'\rImage verification failed. ({verification_error(err)})')
+            return 1
+
+
+def artifact_name(args, ext):
+    return '' if args.basename == '' else args.basename + ext
+
+
+def download_image(args, info, outdir, cnkpath, store=None):
+    # Fetch the chunklist first so that the image is verified while it is being downloaded.
+    chunks = ChunkList.load(cnkpath)
+    return save_mirrored(args.mirror, info[INFO_PRODUCT], info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], artifact_name(args, '.dmg'), outdir,
+                         segments=args.segments, chunks=chunks, resume=args.resume, store=store, jobs=args.jobs)
+
+
+def download_product(args, info, outdir, store=None):
+    cnkpath = save_mirrored(args.mirror, info[INFO_PRODUCT], info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], artifact_name(args, '.chunklist'), outdir, chunklist_check(info))
+    return [cnkpath, download_image(args, info, outdir, cnkpath, store)]
+
+
+def load_manifest(args):
+    """
+    Read batch targets, one per line as: board-id [mlb] [os type] [diag], # starts a comment.
+    Repeated targets are only read once.
+    """
+    targets = []
+    with open(args.manifest, 'r', encoding='utf-8') as fh:
+        for number, line in enumerate(fh, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            diag = fields[-1] == 'diag'
+            if diag:
+                fields.pop()
+            if not fields or len(fields) > 3 or (len(fields) > 2 and fields[2] not in ['default', 'latest']) or (len(fields) > 1 and len(fields[1]) != 17):
+                raise ValueError(f'{args.manifest}:{number}: invalid target {line.strip()}')
+            board, mlb, os_type = (fields + [args.mlb, args.os_type][len(fields) - 1:])[:3]
+            if (board, mlb, os_type, diag) not in targets:
+                targets.append((board, mlb, os_type, diag))
+    return targets
+
+
+def target_outdir(args, target):
+    """
+    Name the output directory of a batch target, the MLB is only part of it when it is not --mlb.
+    """
+    board, mlb, os_type, diag = target
+    return os.path.join(args.outdir, '-'.join([board] + ([mlb] if mlb != args.mlb else []) + [os_type] + (['diag'] if diag else [])))
+
+
+def link_artifacts(paths, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    for path in paths:
+        target = os.path.join(outdir, os.path.basename(path))
+        if os.path.abspath(target) == os.path.abspath(path):
+            continue
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(path, target)
+        except OSError:
+            # Hard links are not available across devices and on some file systems.
+            shutil.copyfile(path, target)
+
+
+def action_batch(args):
+    """
+    Download recovery images for every manifest target, fetching each distinct product only once.
+
+    Targets are saved to <outdir>/<board-id>[-<mlb>]-<os type>[-diag], targets sharing a product get hard links.
+    Products download in parallel so that no more than --concurrency connections are open at once,
+    all of them sharing the --bandwidth budget.
+    """
+    try:
+        targets = load_manifest(args)
+    except (OSError, ValueError) as err:
+        print(f'ERROR: Failed to load manifest: {err}')
+        return 1
+
+    get_session(args)
+    limiter = RateLimiter(args.rate)
+
+    def resolve(target):
+        board, mlb, os_type, diag = target
+        limiter.wait()
+        return asset_image_info(args, bid=board, mlb=mlb, diag=diag, os_type=os_type)
+
+    products = {}
+    owners = {}
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for target, future in [(target, executor.submit(resolve, target)) for target in targets]:
+            try:
+                info = future.result()
+            except Exception as err:
+                print(f'ERROR: Failed to resolve {" ".join(target[:3])}: {verification_error(err)}')
+                failed += 1
+                continue
+            # Two products must never download into the same directory.
+            outdir = target_outdir(args, target)
+            owner = owners.setdefault(os.path.normcase(os.path.abspath(outdir)), info[INFO_PRODUCT])
+            if owner != info[INFO_PRODUCT]:
+                print(f'ERROR: Target {" ".join(target[:3])} resolves to {info[INFO_PRODUCT]}, but {outdir} already holds {owner}')
+                failed += 1
+                continue
+            products.setdefault(info[INFO_PRODUCT], (info, []))[1].append(target)
+
+    print(f'Resolved {len(targets) - failed} targets to {len(products)} products')
+    store = open_chunk_store(args)
+
+    def fetch(product):
+        info, group = products[product]
+        outdirs = list(dict.fromkeys(target_outdir(args, target) for target in group))
+        paths = artifact_paths(args, info, outdirs[0])
+        if not skip_verified(args, info, outdirs[0]):
+            print(f'Downloading {product} for {len(group)} targets...')
+            os.makedirs(args.outdir, exist_ok=True)
+            paths = download_product(args, info, outdirs[0], store)
+            record_verified(info, paths)
+        for outdir in outdirs[1:]:
+            if args.force or not is_verified(info, artifact_paths(args, info, outdir)):
+                link_artifacts(paths, outdir)
+                record_verified(info, artifact_paths(args, info, outdir))
+        return len(group)
+
+    workers = max(1, args.concurrency // args.segments)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {product: executor.submit(fetch, product) for product in products}
+        for product, future in futures.items():
             try:
-                tb = sys.exc_info()[2]
-                while tb.tb_next:
-                    tb = tb.tb_next
-                err = linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
-            except Exception:
-                err = "Invalid chunklist"
-        print(f'\rImage verification failed. ({err})')
+                future.result()
+                print(f'SUCCESS: {product} downloaded and verified')
+            except Exception as err:
+                print(f'\rERROR: Failed to download {product}: {verification_error(err)}')
+                failed += len(products[product][1])
+
+    if store is not None:
+        store.evict()
+    print(f'{len(targets) - failed} of {len(targets)} targets complete')
+    return 1 if failed else 0
+
+
+def action_check(args):
+    """
+    Verify previously downloaded image against its chunklist.
+    """
+    basename = 'BaseSystem' if args.basename == '' else args.basename
+    dmgpath = os.path.join(args.outdir, basename + '.dmg')
+    cnkpath = os.path.join(args.outdir, basename + '.chunklist')
+    try:
+        verify_image(dmgpath, cnkpath, args.jobs, args.quick_verify)
+        return 0
+    except Exception as err:
+        print(f'\rImage verification failed. ({verification_error(err)})')
         return 1
 
 
@@ -319,15 +1772,151 @@ def action_selfcheck(args):
     return default_recovery(ppp = ppp)              # Returns oldest.
     """
 
-    session = get_session(args)
-    valid_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='default')
-    valid_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='latest')
-    product_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='default')
-    product_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='latest')
-    generic_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='default')
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
-
+    # Selfcheck exists to confirm the server logic, so nothing may be inferred from it here.
+    planner = QueryPlanner(args, args.concurrency, infer=False)
+    code = planner.run([selfcheck_plan(args.verbose)])[0]
     if args.verbose:
+        print(planner.report())
+    return code
+
+
+class QueryPlanner:
+    """
+    Drive query plans, generators yielding lists of independent (board-id, MLB, os type) image info
+    queries and receiving the list of image infos, or the query exception, in return.
+
+    Queries asked by several plans are sent once, queries whose answer follows from the server logic
+    confirmed by selfcheck are inferred, and independent queries of up to concurrency plans run at once
+    on a thread pool. The decision logic stays in the plans, which run on the calling thread.
+    """
+
+    def __init__(self, args, concurrency=1, limiter=None, infer=True):
+        self.args = args
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.infer = infer
+        self.lock = threading.Lock()
+        self.answers = {}
+        self.requested = 0
+
+    @property
+    def sent(self):
+        return len(self.answers)
+
+    def report(self):
+        return f'Sent {self.sent} of {self.requested} image info queries, saved {self.requested - self.sent}'
+
+    def key(self, bid, mlb, os_type):
+        if self.infer and mlb == MLB_ZERO:
+            # Zero MLB gives the latest product for either os type.
+            os_type = 'latest'
+        return bid, mlb, os_type
+
+    def query(self, bid, mlb, os_type):
+        if self.limiter is not None:
+            self.limiter.wait()
+        return session_image_info(self.args, bid=bid, mlb=mlb, diag=False, os_type=os_type)
+
+    def submit(self, executor, query):
+        key = self.key(*query)
+        with self.lock:
+            self.requested += 1
+            if key not in self.answers:
+                self.answers[key] = executor.submit(self.query, *key)
+            return self.answers[key]
+
+    def run(self, plans, done=None):
+        """
+        Run plans to completion, returning their results in order and calling done(index, result, seconds)
+        as each one finishes.
+        """
+        plans = list(plans)
+        results = [None] * len(plans)
+        active = {}
+
+        def advance(index, infos=None, error=None):
+            plan, start, _ = active[index]
+            try:
+                queries = plan.send(infos) if error is None else plan.throw(error)
+            except StopIteration as stop:
+                del active[index]
+                results[index] = stop.value
+                if done is not None:
+                    done(index, stop.value, time.monotonic() - start)
+                return
+            active[index] = (plan, start, [self.submit(executor, query) for query in queries])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            waiting = iter(enumerate(plans))
+            while True:
+                # Keep up to concurrency plans in flight, starting the next one as soon as one finishes.
+                while len(active) < self.concurrency:
+                    index, plan = next(waiting, (None, None))
+                    if plan is None:
+                        break
+                    active[index] = (plan, time.monotonic(), [])
+                    advance(index)
+                if not active:
+                    return results
+                concurrent.futures.wait([future for _, _, futures in active.values() for future in futures],
+                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for index, (_, _, futures) in list(active.items()):
+                    if all(future.done() for future in futures):
+                        errors = [future.exception() for future in futures if future.exception() is not None]
+                        if errors:
+                            advance(index, error=errors[0])
+                        else:
+                            advance(index, [dict(future.result()) for future in futures])
+
+    async def arun(self, engine, plans, done=None):
+        """
+        Coroutine variant of run, answering queries with the asyncio engine.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def query(bid, mlb, os_type):
+            if self.limiter is not None:
+                await asyncio.sleep(self.limiter.reserve())
+            return await engine.session_image_info(self.args, bid=bid, mlb=mlb, diag=False, os_type=os_type)
+
+        async def answer(query_args):
+            key = self.key(*query_args)
+            self.requested += 1
+            if key not in self.answers:
+                self.answers[key] = asyncio.ensure_future(query(*key))
+            return dict(await asyncio.shield(self.answers[key]))
+
+        async def drive(index, plan):
+            async with semaphore:
+                start = time.monotonic()
+                infos, error = None, None
+                while True:
+                    try:
+                        queries = plan.send(infos) if error is None else plan.throw(error)
+                    except StopIteration as stop:
+                        if done is not None:
+                            done(index, stop.value, time.monotonic() - start)
+                        return stop.value
+                    infos, error = None, None
+                    try:
+                        infos = await asyncio.gather(*[answer(query_args) for query_args in queries])
+                    except Exception as e:
+                        error = e
+
+        return await asyncio.gather(*[drive(index, plan) for index, plan in enumerate(plans)])
+
+
+def selfcheck_plan(verbose=False):
+    valid_default, valid_latest, product_default, product_latest, generic_default, generic_latest = yield [
+        (RECENT_MAC, MLB_VALID, 'default'),
+        (RECENT_MAC, MLB_VALID, 'latest'),
+        (RECENT_MAC, MLB_PRODUCT, 'default'),
+        (RECENT_MAC, MLB_PRODUCT, 'latest'),
+        (RECENT_MAC, MLB_ZERO, 'default'),
+        (RECENT_MAC, MLB_ZERO, 'latest'),
+    ]
+
+    if verbose:
         print(valid_default)
         print(valid_latest)
         print(product_default)
@@ -365,17 +1954,27 @@ def action_selfcheck(args):
     return 0
 
 
-def action_verify(args):
+def verify_mlb(args, bid, mlb, verbose=False):
     """
-    Try to verify MLB serial number.
+    Try to verify MLB serial number, returning the verdict lines.
     """
-    session = get_session(args)
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
-    uvalid_default = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='default')
-    uvalid_latest = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='latest')
-    uproduct_default = get_image_info(session, bid=args.board_id, mlb=product_mlb(args.mlb), diag=False, os_type='default')
-
-    if args.verbose:
+    return QueryPlanner(args).run([verify_plan(bid, mlb, verbose)])[0]
+
+
+def verify_plan(bid, mlb, verbose=False):
+    queries = [
+        (RECENT_MAC, MLB_ZERO, 'latest'),
+        (bid, mlb, 'default'),
+        (bid, mlb, 'latest'),
+    ]
+    if verbose:
+        # Every answer gets printed, so there is nothing to short-circuit.
+        queries.append((bid, product_mlb(mlb), 'default'))
+    infos = yield queries
+    generic_latest, uvalid_default, uvalid_latest = infos[:3]
+    uproduct_default = infos[3] if verbose else None
+
+    if verbose:
         print(generic_latest)
         print(uvalid_default)
         print(uvalid_latest)
@@ -383,85 +1982,978 @@ def action_verify(args):
 
     # Verify our MLB number.
     if uvalid_default[INFO_PRODUCT] != uvalid_latest[INFO_PRODUCT]:
-        print(f'SUCCESS: {args.mlb} MLB looks valid and supported!' if uvalid_latest[INFO_PRODUCT] == generic_latest[INFO_PRODUCT] else f'SUCCESS: {args.mlb} MLB looks valid, but probably unsupported!')
-        return 0
+        return [f'SUCCESS: {mlb} MLB looks valid and supported!' if uvalid_latest[INFO_PRODUCT] == generic_latest[INFO_PRODUCT] else f'SUCCESS: {mlb} MLB looks valid, but probably unsupported!']
 
-    print('UNKNOWN: Run selfcheck, check your board-id, or try again later!')
+    verdict = ['UNKNOWN: Run selfcheck, check your board-id, or try again later!']
 
     # Here we have matching default and latest products. This can only be true for very
     # new models. These models get either latest or special builds.
     if uvalid_default[INFO_PRODUCT] == generic_latest[INFO_PRODUCT]:
-        print(f'UNKNOWN: {args.mlb} MLB can be valid if very new!')
-        return 0
+        return verdict + [f'UNKNOWN: {mlb} MLB can be valid if very new!']
+    if uproduct_default is None:
+        uproduct_default, = yield [(bid, product_mlb(mlb), 'default')]
     if uproduct_default[INFO_PRODUCT] != uvalid_default[INFO_PRODUCT]:
-        print(f'UNKNOWN: {args.mlb} MLB looks invalid, other models use product {uproduct_default[INFO_PRODUCT]} instead of {uvalid_default[INFO_PRODUCT]}!')
-        return 0
-    print(f'UNKNOWN: {args.mlb} MLB can be valid if very new and using special builds!')
+        return verdict + [f'UNKNOWN: {mlb} MLB looks invalid, other models use product {uproduct_default[INFO_PRODUCT]} instead of {uvalid_default[INFO_PRODUCT]}!']
+    return verdict + [f'UNKNOWN: {mlb} MLB can be valid if very new and using special builds!']
+
+
+def action_verify(args):
+    """
+    Try to verify MLB serial number.
+    """
+    planner = QueryPlanner(args, args.concurrency)
+    for line in planner.run([verify_plan(args.board_id, args.mlb, args.verbose)])[0]:
+        print(line)
+    if args.verbose:
+        print(planner.report())
     return 0
 
 
+def guess_plan(model, version, mlb):
+    """
+    Check whether MLB looks supported on given model, returning (supported entry, warning).
+    """
+    try:
+        if mlb.startswith('000'):
+            # For anonymous lookup check when given model does not match latest.
+            generic_latest, model_latest = yield [(RECENT_MAC, MLB_ZERO, 'latest'), (model, MLB_ZERO, 'latest')]
+
+            if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                if version == 'current':
+                    return None, f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}'
+                return None, None
+
+            user_default, = yield [(model, mlb, 'default')]
+
+            if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]], None
+        else:
+            # For normal lookup check when given model has mismatching normal and latest.
+            user_latest, user_default = yield [(model, mlb, 'latest'), (model, mlb, 'default')]
+
+            if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]], None
+
+    except Exception as e:
+        return None, f'WARN: Failed to check {model}, exception: {e}'
+
+    return None, None
+
+
+def sweep_models(planner, db, mlb, quiet=False, engine=None):
+    """
+    Run guess_plan over every model, returning (model, entry, warning, seconds) in db order.
+    Returns a coroutine when given the asyncio engine.
+    """
+    models = list(db)
+    seconds = [0.0] * len(models)
+    progress = Progress()
+    checked = []
+
+    def done(index, _, elapsed):
+        seconds[index] = elapsed
+        checked.append(index)
+        if not quiet and (progress.due() or len(checked) == len(models)):
+            print(f'\rChecked {len(checked)} of {len(models)} models...', end='')
+            sys.stdout.flush()
+
+    def collect(results):
+        if not quiet:
+            print('\r', end='')
+        return [(model,) + tuple(result) + (seconds[index],) for index, (model, result) in enumerate(zip(models, results))]
+
+    plans = [guess_plan(model, db[model], mlb) for model in models]
+    if engine is None:
+        return collect(planner.run(plans, done))
+
+    async def sweep():
+        return collect(await planner.arun(engine, plans, done))
+
+    return sweep()
+
+
 def action_guess(args):
     """
     Attempt to guess which model does this MLB belong.
     """
 
     mlb = args.mlb
-    anon = mlb.startswith('000')
 
     with open(args.board_db, 'r', encoding='utf-8') as fh:
         db = json.load(fh)
 
+    planner = QueryPlanner(args, args.concurrency, RateLimiter(args.rate))
+
+    start = time.monotonic()
+    results = sweep_models(planner, db, mlb)
+    return report_guess(args, results, time.monotonic() - start, planner)
+
+
+def report_guess(args, results, elapsed, planner):
+    mlb = args.mlb
     supported = {}
 
-    session = get_session(args)
+    for model, entry, warning, _ in results:
+        if warning is not None:
+            print(warning)
+        if entry is not None:
+            supported[model] = entry
 
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
+    timings = sorted((seconds, model) for model, _, _, seconds in results)
+    if args.verbose:
+        for seconds, model in timings:
+            print(f'{model}: {seconds:.3f}s')
+    if timings:
+        print(f'Checked {len(timings)} models in {elapsed:.3f}s, per model: min {timings[0][0]:.3f}s,'
+              f' avg {sum(seconds for seconds, _ in timings) / len(timings):.3f}s, max {timings[-1][0]:.3f}s ({timings[-1][1]})')
+    print(planner.report())
 
-    for model in db:
+    if len(supported) > 0:
+        print(f'SUCCESS: MLB {mlb} looks supported for:')
+        for model in supported:
+            print(f'- {model}, up to {supported[model][0]}, default: {supported[model][1]}, latest: {supported[model][2]}')
+        return 0
+
+    print(f'UNKNOWN: Failed to determine supported models for MLB {mlb}!')
+    return None
+
+
+class RecoveryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        purl = urlparse(self.path)
+        route = self.server.routes.get(purl.path)
+        if route is None:
+            self.reply(404, {'error': f'Unknown endpoint {purl.path}'})
+            return
+        query = {key: values[-1] for key, values in parse_qs(purl.query).items()}
         try:
-            if anon:
-                # For anonymous lookup check when given model does not match latest.
-                model_latest = get_image_info(session, bid=model, mlb=MLB_ZERO, diag=False, os_type='latest')
+            self.reply(200, route(query))
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+        except QueryError as e:
+            # The session may have expired, start a new one for the next request.
+            QUERY_CACHE.forget('session')
+            self.reply(502, {'error': f'{type(e).__name__}: {e}'})
+        except Exception as e:
+            self.reply(502, {'error': f'{type(e).__name__}: {e}'})
 
-                if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    if db[model] == 'current':
-                        print(f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}')
-                    continue
 
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
+class MirrorFill:
+    """
+    Image being filled from origin into a partial file one verified chunk at a time, which clients
+    read from while it grows instead of waiting for the whole image.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.cond = threading.Condition()
+        self.length = 0
+        self.error = None
+        self.done = False
+        self.fh = open(path, 'wb')
+
+    def write(self, data):
+        self.fh.write(data)
+        self.fh.flush()
+        with self.cond:
+            self.length += len(data)
+            self.cond.notify_all()
+
+    def flush(self):
+        self.fh.flush()
+
+    def open(self):
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+            return open(self.path, 'rb')
+
+    def wait(self, offset):
+        """
+        Wait until data past offset has been filled, returning the filled length, or raise the fill error.
+        """
+        with self.cond:
+            while self.length <= offset and not self.done:
+                self.cond.wait()
+            if self.length <= offset and self.error is not None:
+                raise self.error
+            return self.length
+
+    def complete(self, path):
+        self.fh.close()
+        with self.cond:
+            os.replace(self.path, path)
+            self.path = path
+            self.done = True
+            self.cond.notify_all()
+
+    def fail(self, error):
+        self.fh.close()
+        with self.cond:
+            os.remove(self.path)
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+
+class RecoveryMirror:
+    """
+    Verified recovery artifacts stored under their product id, filled from origin on demand and evicted
+    least recently used first once over the disk budget. Only chunklists with a valid signature and images
+    matching them are ever stored. The origin links come from clients though, so a product may hold another
+    product's artifacts, clients check the chunklist against the hash in their image info before using it.
+    """
 
-                if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]]
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.fills = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path_lock(self, path):
+        with self.lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def fetch(self, product, filename, origin, token):
+        """
+        Return the mirrored path and, for an image still being filled from origin, its MirrorFill.
+        """
+        directory = os.path.join(self.directory, product)
+        path = os.path.join(directory, filename)
+        with self.path_lock(path):
+            if os.path.exists(path):
+                os.utime(directory)
+                return path, None
+            with self.lock:
+                fill = self.fills.get(path)
+            if fill is not None:
+                return path, fill
+            if origin == '':
+                raise FileNotFoundError(f'{product}/{filename} is not mirrored')
+            if urlparse(origin).scheme not in ['http', 'https'] or os.path.basename(urlparse(origin).path) != filename:
+                raise ValueError(f'Invalid origin {origin} for {filename}')
+
+            partname = f'.{filename}.partial'
+            partpath = os.path.join(directory, partname)
+            stem, ext = os.path.splitext(filename)
+            os.makedirs(directory, exist_ok=True)
+            if ext == '.chunklist':
+                try:
+                    ChunkList.load(save_image(origin, token, partname, directory))
+                    os.replace(partpath, path)
+                finally:
+                    # Never leave a failed fill behind.
+                    if os.path.exists(partpath):
+                        os.remove(partpath)
             else:
-                # For normal lookup check when given model has mismatching normal and latest.
-                user_latest = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='latest')
+                cnkpath = os.path.join(directory, stem + '.chunklist')
+                if not os.path.exists(cnkpath):
+                    raise FileNotFoundError(f'{product}/{stem}.chunklist must be mirrored before {filename}')
+                chunks = ChunkList.load(cnkpath)
+                fill = MirrorFill(partpath, chunks.size)
+                with self.lock:
+                    self.fills[path] = fill
+                threading.Thread(target=self.fill, args=(product, path, fill, origin, token, chunks), daemon=True).start()
+                return path, fill
+
+        self.evict(product)
+        return path, None
+
+    def fill(self, product, path, fill, origin, token, chunks):
+        try:
+            print(f'Mirroring {origin} to {path}...')
+            sink = ChunkStream(fill, chunks)
+            stream_resumable(origin, asset_headers(origin, token), sink, Progress())
+            sink.finish()
+            fill.complete(path)
+            print(f'\rMirrored {product}/{os.path.basename(path)}\t\t\t\t\t')
+        except Exception as e:
+            print(f'\rWARN: Failed to mirror {product}/{os.path.basename(path)}: {verification_error(e)}')
+            fill.fail(e)
+        finally:
+            with self.lock:
+                del self.fills[path]
+        self.evict(product)
+
+    def evict(self, keep):
+        with self.lock:
+            filling = [os.path.dirname(path) for path in self.fills]
+        products = []
+        for product in os.listdir(self.directory):
+            directory = os.path.join(self.directory, product)
+            if not os.path.isdir(directory):
+                continue
+            names = os.listdir(directory)
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+            # Products still being filled are never evicted.
+            busy = product == keep or directory in filling
+            products.append((os.path.getmtime(directory), size, busy, directory))
+        total = sum(size for _, size, _, _ in products)
+        for _, size, busy, directory in sorted(products):
+            if total <= self.budget:
+                break
+            if not busy:
+                shutil.rmtree(directory, ignore_errors=True)
+                total -= size
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, code, message, headers=None):
+        body = (message + '\n').encode('utf-8')
+        self.send_response(code)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        purl = urlparse(self.path)
+        parts = [unquote(part) for part in purl.path.split('/')]
+        if len(parts) != 3 or any(part in ['', '.', '..'] or part.startswith('.') for part in parts[1:]):
+            self.reply(404, 'Not found')
+            return
+        origin = parse_qs(purl.query).get('origin', [''])[-1]
+        token = ''
+        for cookie in self.headers.get('Cookie', '').split('; '):
+            if cookie.startswith('AssetToken='):
+                token = cookie[len('AssetToken='):]
 
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
+        try:
+            path, fill = self.server.mirror.fetch(parts[1], parts[2], origin, token)
+            fh = open(path, 'rb') if fill is None else fill.open()
+        except FileNotFoundError as e:
+            self.reply(404, str(e))
+            return
+        except Exception as e:
+            self.reply(502, f'Failed to mirror {parts[1]}/{parts[2]}: {verification_error(e)}')
+            return
 
-                if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]]
+        try:
+            self.send_artifact(fh, fill)
+        except Exception:
+            if fill is None:
+                raise
+            # The fill failed after the headers went out, a short body lets the client resume or fall back.
+            self.close_connection = True
+
+    def send_artifact(self, fh, fill=None):
+        with fh:
+            size = os.fstat(fh.fileno()).st_size if fill is None else fill.size
+            start, end, code = 0, size, 200
+            rng = self.headers.get('Range', '')
+            if rng.startswith('bytes=') and ',' not in rng:
+                first, _, last = rng[6:].strip().partition('-')
+                try:
+                    if first == '':
+                        start = max(0, size - int(last))
+                    else:
+                        start = int(first)
+                        end = min(size, int(last) + 1) if last != '' else size
+                except ValueError:
+                    start = size
+                if start >= end:
+                    self.reply(416, 'Invalid range', {'Content-Range': f'bytes */{size}'})
+                    return
+                code = 206
+
+            self.send_response(code)
+            if code == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            fh.seek(start)
+            while start < end:
+                # Images still being filled are sent as far as they are verified, waiting for the rest.
+                available = end if fill is None else fill.wait(start)
+                block = fh.read(min(2**20, end - start, available - start))
+                if not block:
+                    break
+                self.wfile.write(block)
+                start += len(block)
+
+
+def serve_address(listen):
+    host, _, port = listen.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def action_mirror(args):
+    """
+    Serve recovery images and chunklists to other hosts from a local verified store.
 
-        except Exception as e:
-            print(f'WARN: Failed to check {model}, exception: {e}')
+    Clients request /<product>/<file name>?origin=<link> with the asset token cookie,
+    missing artifacts are fetched from the origin link once and verified.
+    """
+    server = ThreadingHTTPServer(serve_address(args.listen), MirrorRequestHandler)
+    server.daemon_threads = True
+    server.mirror = RecoveryMirror(args.mirror_dir, args.mirror_size * 2**20)
+    server.verbose = args.verbose
 
-    if len(supported) > 0:
-        print(f'SUCCESS: MLB {mlb} looks supported for:')
-        for model in supported.items():
-            print(f'- {model}, up to {supported[model][0]}, default: {supported[model][1]}, latest: {supported[model][2]}')
+    print(f'Mirroring recovery images from {args.mirror_dir} on http://{server.server_address[0]}:{server.server_address[1]}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def query_mlb(query):
+    mlb = query.get('mlb', MLB_ZERO)
+    if len(mlb) != 17:
+        raise ValueError('Cannot use MLBs in non 17 character format!')
+    return mlb
+
+
+def action_serve(args):
+    """
+    Serve image info, MLB verification and model guesses as a local JSON API:
+
+    /info?board_id=...&mlb=...&os_type=...&diag=1
+    /verify?board_id=...&mlb=...
+    /guess?mlb=...
+    """
+
+    def info(query):
+        bid = query.get('board_id', RECENT_MAC)
+        os_type = query.get('os_type', 'default')
+        if os_type not in ['default', 'latest']:
+            raise ValueError(f'Invalid os type {os_type}')
+        return asset_image_info(args, bid=bid, mlb=query_mlb(query), diag=query.get('diag', '0') not in ['', '0'], os_type=os_type)
+
+    def verify(query):
+        bid = query.get('board_id', RECENT_MAC)
+        mlb = query_mlb(query)
+        key = json.dumps(['verify', bid, mlb])
+        return {'board_id': bid, 'mlb': mlb, 'verdict': QUERY_CACHE.fetch(key, lambda: verify_mlb(args, bid, mlb))}
+
+    def guess(query):
+        mlb = query_mlb(query)
+
+        def sweep():
+            planner = QueryPlanner(args, args.concurrency, RateLimiter(args.rate))
+            return sweep_models(planner, db, mlb, quiet=True)
+
+        results = QUERY_CACHE.fetch(json.dumps(['guess', mlb]), sweep)
+        return {
+            'mlb': mlb,
+            'supported': {model: entry for model, entry, _, _ in results if entry is not None},
+            'warnings': [warning for _, _, warning, _ in results if warning is not None],
+        }
+
+    def warm():
+        # Renew the session before it expires so that requests never wait for a handshake.
+        while True:
+            time.sleep(max(1, args.cache_ttl / 2))
+            QUERY_CACHE.forget('session')
+            try:
+                get_session(args)
+            except Exception as e:
+                print(f'WARN: Failed to renew session: {e}')
+
+    with open(args.board_db, 'r', encoding='utf-8') as fh:
+        db = json.load(fh)
+
+    server = ThreadingHTTPServer(serve_address(args.listen), RecoveryRequestHandler)
+    server.daemon_threads = True
+    server.routes = {'/info': info, '/verify': verify, '/guess': guess}
+    server.verbose = args.verbose
+
+    get_session(args)
+    if args.cache_ttl > 0:
+        threading.Thread(target=warm, daemon=True).start()
+
+    print(f'Serving recovery information on http://{server.server_address[0]}:{server.server_address[1]}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+async def within(awaitable):
+    """
+    Await with the per-request timeout, failing like a blocking socket would.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, RETRY.timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError('timed out') from None
+
+
+class AsyncResponse:
+    """
+    HTTP/1.1 response body read from an asyncio stream, handing its connection back to the pool once fully read.
+    """
+
+    def __init__(self, pool, key, reader, writer, status, reason, headers):
+        self.pool = pool
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.fields = {name.lower(): value for name, value in headers.items()}
+        self.chunked = 'chunked' in self.fields.get('transfer-encoding', '').lower()
+        self.length = None if self.chunked or 'content-length' not in self.fields else int(self.fields['content-length'])
+        self.will_close = self.fields.get('connection', '').lower() == 'close' or (not self.chunked and self.length is None)
+        self.chunk_left = 0
+        self.done = False
+
+    def getheader(self, name, default=None):
+        return self.fields.get(name.lower(), default)
+
+    def getcode(self):
+        return self.status
+
+    async def read(self, amt=2**20):
+        if self.done:
+            return b''
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await within(self.reader.readline())
+                if not line:
+                    raise IncompleteRead(b'')
+                self.chunk_left = int(line.split(b';')[0], 16)
+                if self.chunk_left == 0:
+                    while (await within(self.reader.readline())) not in [b'\r\n', b'\n', b'']:
+                        continue
+                    self.finish()
+                    return b''
+            data = await within(self.reader.read(min(amt, self.chunk_left)))
+            if not data:
+                raise IncompleteRead(b'', self.chunk_left)
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await within(self.reader.readline())
+            return data
+        if self.length is not None:
+            if self.length == 0:
+                self.finish()
+                return b''
+            data = await within(self.reader.read(min(amt, self.length)))
+            if not data:
+                raise IncompleteRead(b'', self.length)
+            self.length -= len(data)
+            if self.length == 0:
+                self.finish()
+            return data
+        data = await within(self.reader.read(amt))
+        if not data:
+            self.finish()
+        return data
+
+    async def readall(self):
+        blocks = []
+        while True:
+            block = await self.read()
+            if not block:
+                return b''.join(blocks)
+            blocks.append(block)
+
+    def finish(self):
+        self.done = True
+        self.close()
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.done and not self.will_close:
+            self.pool.release(self.key, self.reader, self.writer)
+        else:
+            self.writer.close()
+        self.writer = None
+
+
+class AsyncConnectionPool:
+    """
+    Keep-alive asyncio stream connections per scheme, host and port, speaking just enough HTTP/1.1
+    for the recovery servers.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.idle = {}
+
+    async def acquire(self, key):
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await within(asyncio.open_connection(host, port or (443 if context else 80), ssl=context, limit=2**20))
+        return reader, writer, False
+
+    def release(self, key, reader, writer):
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle = {}
+
+    async def request(self, method, url, headers, data=None):
+        purl = urlparse(url)
+        key = (purl.scheme, purl.hostname, purl.port)
+        path = purl.path or '/'
+        if purl.query:
+            path += '?' + purl.query
+        lines = [f'{method} {path} HTTP/1.1'] + [f'{header}: {value}' for header, value in headers.items()]
+        if not any(header.lower() == 'host' for header in headers):
+            lines.append(f'Host: {purl.netloc}')
+        if data is not None:
+            lines.append(f'Content-Length: {len(data)}')
+        message = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b'')
+
+        while True:
+            reader, writer, reused = await self.acquire(key)
+            try:
+                writer.write(message)
+                await within(writer.drain())
+                status = await within(reader.readline())
+                if not status:
+                    raise RemoteDisconnected('Remote end closed connection without response')
+                _, code, reason = (status.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+                fields = {}
+                while True:
+                    line = await within(reader.readline())
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    fields.setdefault(name.strip(), value.strip())
+                return AsyncResponse(self, key, reader, writer, int(code), reason, fields)
+            except BaseException as e:
+                writer.close()
+                # Idle connections may have been dropped by the server, retry those on a fresh one.
+                if not reused or not isinstance(e, (HTTPException, OSError)):
+                    raise
+
+    async def urlopen(self, url, headers, data=None):
+        method = 'GET' if data is None else 'POST'
+        for _ in range(10):
+            response = await self.request(method, url, headers, data)
+            if response.status in ConnectionPool.REDIRECTS and response.getheader('Location'):
+                await response.readall()
+                response.close()
+                url = urljoin(url, response.getheader('Location'))
+                headers = {key: value for key, value in headers.items() if key.lower() not in ['host', 'content-type', 'content-length']}
+                if response.status in [301, 302, 303]:
+                    method, data = 'GET', None
+                continue
+            if response.status >= 400:
+                body = await response.readall()
+                response.close()
+                raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            return response
+        raise HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+
+class AsyncEngine:
+    """
+    Asyncio counterpart of the blocking queries and downloads, sharing their request building, parsing,
+    query cache, plans and chunk verification. Hashing and file writes run on the default executor
+    while the next block is received.
+    """
+
+    def __init__(self):
+        self.pool = AsyncConnectionPool()
+
+    def close(self):
+        self.pool.close()
+
+    async def query(self, url, headers, post=None, raw=False):
+        data = query_data(post)
+        for attempt in range(RETRY.attempts + 1):
+            start = time.monotonic()
+            try:
+                response = await self.pool.urlopen(url, headers, data)
+                METRICS.request(url, response.getcode(), time.monotonic() - start)
+                if raw:
+                    return response
+                try:
+                    return response.headers, await response.readall()
+                finally:
+                    response.close()
+            except (HTTPException, OSError) as e:
+                await asyncio.sleep(query_failed(url, attempt, e, start))
+
+    async def timed(self, name, func, *args):
+        with METRICS.phase(name):
+            return await func(*args)
+
+    async def hedged(self, func, *args):
+        if RETRY.hedge <= 0:
+            return await func(*args)
+        tasks = [asyncio.ensure_future(func(*args))]
+        try:
+            if not (await asyncio.wait(tasks, timeout=RETRY.hedge))[0]:
+                hedge_started(func)
+                tasks.append(asyncio.ensure_future(func(*args)))
+            error = None
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except Exception as e:
+                    error = error or e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def session(self, args):
+        return await QUERY_CACHE.afetch('session', lambda: self.timed('session', self.query_session, args))
+
+    async def renew_session(self, args, session):
+        if not QUERY_CACHE.stale('session', session):
+            return None
+        QUERY_CACHE.forget('session', session)
+        return await self.session(args)
+
+    async def session_image_info(self, args, bid, mlb=MLB_ZERO, diag=False, os_type='default'):
+        session = await self.session(args)
+        try:
+            return await self.image_info(session, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+        except QueryError:
+            session = await self.renew_session(args, session)
+            if session is None:
+                raise
+            return await self.image_info(session, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+
+    async def query_session(self, args):
+        headers, _ = await self.query(*session_query())
+        return parse_session(headers, args.verbose)
+
+    async def asset_image_info(self, args, bid, mlb=MLB_ZERO, diag=False, os_type='default'):
+        info = await self.session_image_info(args, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+        key = image_info_key(bid, mlb, os_type, diag)
+        if not QUERY_CACHE.stale(key, info):
+            return info
+        QUERY_CACHE.forget(key, info)
+        return await self.session_image_info(args, bid=bid, mlb=mlb, diag=diag, os_type=os_type)
+
+    async def image_info(self, session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+        key = image_info_key(bid, mlb, os_type, diag)
+        return dict(await QUERY_CACHE.afetch(key, lambda: self.timed('info', self.hedged, self.query_image_info, session, bid, mlb, diag, os_type, cid)))
+
+    async def query_image_info(self, session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+        _, output = await self.query(*image_info_query(session, bid, mlb, diag, os_type, cid))
+        return parse_image_info(output)
+
+    async def query_size(self, url, headers):
+        response = await self.query(url, dict(headers, Range='bytes=0-0'), raw=True)
+        try:
+            size = range_size(response.getcode(), response.getheader('Content-Range', ''))
+            if size is not None:
+                try:
+                    await response.readall()
+                except (HTTPException, OSError):
+                    # Only the header matters, a broken body just costs the connection.
+                    pass
+            return size
+        finally:
+            response.close()
+
+    async def stream_response(self, response, fh, progress, verifier=None, length=None):
+        loop = asyncio.get_running_loop()
+        pending = None
+        received = 0
+        try:
+            while length is None or received < length:
+                try:
+                    block = await response.read(2**20 if length is None else min(2**20, length - received))
+                except (HTTPException, OSError) as e:
+                    raise TransferError(e) from e
+                if not block:
+                    break
+                if pending is not None:
+                    await pending
+                # Verify and write this block while the next one is being received.
+                pending = loop.run_in_executor(None, write_block, fh, verifier, block)
+                received += len(block)
+                progress(len(block))
+                await asyncio.sleep(BANDWIDTH.reserve(len(block)))
+        finally:
+            if pending is not None:
+                await pending
+        return received
+
+    async def stream_resumable(self, url, headers, fh, progress, verifier=None, end=None):
+        transfer = ResumableTransfer(url, headers, fh, end)
+        while True:
+            try:
+                response = await self.query(url, transfer.request_headers(), raw=True)
+                try:
+                    length = transfer.accept(response.getcode(), response.getheader('Content-Length'), response.getheader('Content-Range', ''))
+                    await self.stream_response(response, fh, progress, verifier, length)
+                finally:
+                    response.close()
+                if transfer.complete():
+                    return transfer.received
+                err = HTTPException(f'Transfer truncated at byte {fh.tell()}')
+            except TransferError as e:
+                err = e
+            await asyncio.sleep(transfer.failed(err))
+
+    async def save_segment(self, url, headers, path, segment, progress, chunks=None, store=None):
+        start, end, first, stop = segment
+        verifier = ChunkVerifier(chunks, first, stop, store) if chunks is not None else None
+        with open(path, 'r+b') as fh:
+            fh.seek(start)
+            await self.stream_resumable(url, headers, fh, progress, verifier, end)
+        if verifier is not None:
+            verifier.finish()
+
+    async def save_image(self, url, sess, filename='', directory='', segments=1, chunks=None, resume=False, store=None, jobs=1):
+        with METRICS.phase('download') as record:
+            progress = Progress()
+            try:
+                return await self.fetch_image(url, sess, filename, directory, progress, segments, chunks, resume, store, jobs)
+            finally:
+                record['bytes'] = progress.total
+
+    async def fetch_image(self, url, sess, filename, directory, progress, segments=1, chunks=None, resume=False, store=None, jobs=1):
+        loop = asyncio.get_running_loop()
+        path, headers, parts = await loop.run_in_executor(None, prepare_image, url, sess, filename, directory, segments, chunks, resume, store, jobs)
+        if parts == []:
+            return path
+
+        size = await self.query_size(url, headers) if wants_ranges(segments, parts) else None
+        slices = image_slices(size, segments, chunks, parts)
+        if slices is not None:
+            allocate_image(path, size, parts is not None)
+            # Cancelling the remaining segments once one fails does what the abort event does for threads.
+            tasks = [asyncio.ensure_future(self.save_segment(url, headers, path, part, progress, chunks, store)) for part in slices]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        else:
+            with open(path, 'wb') as fh:
+                verifier = ChunkVerifier(chunks, store=store) if chunks is not None else None
+                await self.stream_resumable(url, headers, fh, progress, verifier)
+                if verifier is not None:
+                    verifier.finish()
+        print('\rDownload complete!\t\t\t\t\t')
+        return path
+
+
+async def async_action_download(engine, args):
+    info = await engine.asset_image_info(args, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
+    if args.verbose:
+        print(info)
+    if skip_verified(args, info, args.outdir):
         return 0
+    print(f'Downloading {info[INFO_PRODUCT]}...')
+    paths = artifact_paths(args, info, args.outdir)
+    cnkpath = await engine.save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], artifact_name(args, '.chunklist'), args.outdir)
+    try:
+        chunks = ChunkList.load(cnkpath)
+        store = open_chunk_store(args)
+        await engine.save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], artifact_name(args, '.dmg'), args.outdir,
+                                args.segments, chunks, args.resume, store, args.jobs)
+        return download_done(info, paths, store)
+    except Exception as err:
+        return download_done(info, paths, err=err)
 
-    print(f'UNKNOWN: Failed to determine supported models for MLB {mlb}!')
-    return None
+
+async def async_action_selfcheck(engine, args):
+    planner = QueryPlanner(args, args.concurrency, infer=False)
+    code, = await planner.arun(engine, [selfcheck_plan(args.verbose)])
+    if args.verbose:
+        print(planner.report())
+    return code
+
+
+async def async_action_verify(engine, args):
+    planner = QueryPlanner(args, args.concurrency)
+    verdict, = await planner.arun(engine, [verify_plan(args.board_id, args.mlb, args.verbose)])
+    for line in verdict:
+        print(line)
+    if args.verbose:
+        print(planner.report())
+    return 0
+
+
+async def async_action_guess(engine, args):
+    with open(args.board_db, 'r', encoding='utf-8') as fh:
+        db = json.load(fh)
+
+    planner = QueryPlanner(args, args.concurrency, RateLimiter(args.rate))
+
+    start = time.monotonic()
+    results = await sweep_models(planner, db, args.mlb, engine=engine)
+    return report_guess(args, results, time.monotonic() - start, planner)
+
+
+ASYNC_ACTIONS = {
+    'download': async_action_download,
+    'selfcheck': async_action_selfcheck,
+    'verify': async_action_verify,
+    'guess': async_action_guess,
+}
+
+
+async def run_async(action, args):
+    engine = AsyncEngine()
+    try:
+        return await action(engine, args)
+    finally:
+        engine.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Gather recovery information for Macs')
-    parser.add_argument('action', choices=['download', 'selfcheck', 'verify', 'guess'],
+    parser.add_argument('action', choices=['download', 'batch', 'check', 'selfcheck', 'verify', 'guess', 'serve', 'mirror'],
                         help='Action to perform: "download" - performs recovery downloading,'
+                        ' "batch" downloads every target of a manifest sharing identical products,'
+                        ' "check" verifies downloaded image with its chunklist,'
                         ' "selfcheck" checks whether MLB serial validation is possible, "verify" performs'
-                        ' MLB serial verification, "guess" tries to find suitable mac model for MLB.')
+                        ' MLB serial verification, "guess" tries to find suitable mac model for MLB,'
+                        ' "serve" answers info, verify and guess queries over local HTTP,'
+                        ' "mirror" caches and serves recovery images to other hosts.')
     parser.add_argument('-o', '--outdir', type=str, default='com.apple.recovery.boot',
                         help='customise output directory for downloading, defaults to com.apple.recovery.boot')
+    parser.add_argument('-O', '--output', type=str, default='',
+                        help='stream verified image to specified pipe or device, or - for stdout, instead of saving to outdir')
     parser.add_argument('-n', '--basename', type=str, default='',
                         help='customise base name for downloading, defaults to remote name')
     parser.add_argument('-b', '--board-id', type=str, default=RECENT_MAC,
@@ -470,6 +2962,53 @@ def main():
                         help=f'use specified logic board serial for downloading, defaults to {MLB_ZERO}')
     parser.add_argument('-e', '--code', type=str, default='',
                         help='generate product logic board serial with specified product EEEE code')
+    parser.add_argument('-s', '--segments', type=int, default=1,
+                        help='download image with specified number of concurrent range requests, defaults to 1')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='resume downloading into an existing image, keeping chunks that pass verification')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='download and verify again even when outdir holds unchanged verified artifacts')
+    parser.add_argument('--chunk-store', type=str, default='',
+                        help='reuse and keep verified image chunks in specified directory across downloads')
+    parser.add_argument('--chunk-store-size', type=int, default=16384,
+                        help='evict least recently used chunks when chunk store exceeds specified MBs, defaults to 16384')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='hash image chunks with specified number of threads, defaults to CPU count')
+    parser.add_argument('--quick-verify', type=int, default=0, metavar='COUNT',
+                        help='check only specified number of randomly chosen chunks')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='send up to specified number of image info queries, check specified number of models or open specified number of batch connections at once, defaults to 8')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='limit guessing and batch to specified number of queries per second, defaults to unlimited')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='limit all downloads together to specified MBs per second, defaults to unlimited')
+    parser.add_argument('--manifest', type=str, default='manifest.txt',
+                        help='read batch targets from specified file, one "board-id [mlb] [os type] [diag]" per line, defaults to manifest.txt')
+    parser.add_argument('--cache-file', type=str, default=os.path.join(CACHE_DIR, 'queries.json'),
+                        help='keep sessions and image info in specified file between runs')
+    parser.add_argument('--cache-ttl', type=int, default=600,
+                        help='reuse cached sessions and image info for specified number of seconds, defaults to 600')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='keep at most specified number of cached queries, defaults to 4096')
+    parser.add_argument('--no-cache', action='store_true', help='bypass query cache')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retry failed queries and interrupted transfers specified number of times, defaults to 3')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='give up on unresponsive connections after specified number of seconds, defaults to 60')
+    parser.add_argument('--hedge', type=float, default=0,
+                        help='send a duplicate image info query when one takes longer than specified seconds, defaults to never')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run download, selfcheck, verify and guess on the asyncio engine')
+    parser.add_argument('--metrics', type=str, default='',
+                        help='append phase timings, request latencies and a summary to specified JSON lines file')
+    parser.add_argument('-l', '--listen', type=str, default='127.0.0.1:8000',
+                        help='listen on specified address and port when serving, defaults to 127.0.0.1:8000')
+    parser.add_argument('--mirror', type=str, default='',
+                        help='download through specified mirror URL, falling back to origin when it fails')
+    parser.add_argument('--mirror-dir', type=str, default='mirror',
+                        help='store mirrored recovery images in specified directory, defaults to mirror')
+    parser.add_argument('--mirror-size', type=int, default=65536,
+                        help='evict least recently used products when mirror exceeds specified MBs, defaults to 65536')
     parser.add_argument('-os', '--os-type', type=str, default='default', choices=['default', 'latest'],
                         help=f'use specified os type, defaults to default {MLB_ZERO}')
     parser.add_argument('-diag', '--diagnostics', action='store_true', help='download diagnostics image')
@@ -482,20 +3021,70 @@ def main():
     if args.code != '':
         args.mlb = mlb_from_eeee(args.code)
 
+    if args.segments < 1 or args.jobs < 1 or args.concurrency < 1:
+        print('ERROR: Segment, job and concurrency counts must be positive!')
+        sys.exit(1)
+
     if len(args.mlb) != 17:
         print('ERROR: Cannot use MLBs in non 17 character format!')
         sys.exit(1)
 
-    if args.action == 'download':
-        return action_download(args)
-    if args.action == 'selfcheck':
-        return action_selfcheck(args)
-    if args.action == 'verify':
-        return action_verify(args)
-    if args.action == 'guess':
-        return action_guess(args)
+    METRICS.path = args.metrics or None
+    RETRY.attempts = max(0, args.retries)
+    RETRY.timeout = args.timeout
+    RETRY.hedge = args.hedge
+    BANDWIDTH.interval = 1.0 / (args.bandwidth * 2**20) if args.bandwidth > 0 else 0
+
+    if not args.no_cache:
+        QUERY_CACHE.path = args.cache_file
+        QUERY_CACHE.ttl = args.cache_ttl
+        QUERY_CACHE.size = args.cache_size
+        QUERY_CACHE.load()
+
+    # Streaming to stdout leaves it to image data alone.
+    log = sys.stderr if args.output == '-' else sys.stdout
 
-    assert False
+    try:
+        if args.use_async and args.action in ASYNC_ACTIONS:
+            if args.mirror or args.output or {'http', 'https'} & set(getproxies()):
+                print('WARN: Asynchronous engine does not support proxies, mirrors or streaming output, using blocking engine', file=sys.stderr)
+            else:
+                return asyncio.run(run_async(ASYNC_ACTIONS[args.action], args))
+        if args.action == 'download':
+            return action_download(args)
+        if args.action == 'batch':
+            return action_batch(args)
+        if args.action == 'check':
+            return action_check(args)
+        if args.action == 'selfcheck':
+            return action_selfcheck(args)
+        if args.action == 'verify':
+            return action_verify(args)
+        if args.action == 'guess':
+            return action_guess(args)
+        if args.action == 'serve':
+            return action_serve(args)
+        if args.action == 'mirror':
+            return action_mirror(args)
+
+        assert False
+    except QueryError as err:
+        print(f'\rERROR: {err}', file=log)
+        return 1
+    finally:
+        QUERY_CACHE.save()
+        METRICS.close()
+        if args.verbose:
+            print(f'Query cache: {QUERY_CACHE.hits} hits, {QUERY_CACHE.misses} misses, {QUERY_CACHE.coalesced} coalesced', file=log)
+            summary = METRICS.summary()
+            for name, phase in summary['phases'].items():
+                line = f'Phase {name}: {phase["count"]} in {phase["seconds"]:.3f}s'
+                if 'throughput' in phase:
+                    line += f', {phase["bytes"]} bytes at {phase["throughput"] / 2**20:.1f} MB/s'
+                print(line, file=log)
+            if 'latency' in summary:
+                print(f'Requests: {summary["requests"]}, latency p50 {summary["latency"]["p50"]:.3f}s,'
+                      f' p90 {summary["latency"]["p90"]:.3f}s, p99 {summary["latency"]["p99"]:.3f}s', file=log)
 
 
 if __name__ == '__main__':
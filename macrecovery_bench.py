@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+"""
+Benchmark macrecovery.py against a local stand-in for the recovery servers.
+
+The stand-in mimics osrecovery.apple.com sessions, RecoveryImage and Diagnostics
+queries, and serves a synthetic image with a chunklist signed by a locally
+generated key. Latency, bandwidth and failures can be injected to reproduce
+slow or flaky links.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import macrecovery
+
+PRODUCT_LATEST = '041-91758'
+PRODUCT_OLDEST = '041-88800'
+PRODUCT_LEGACY = '041-61002'
+PRODUCT_DIAGNOSTICS = '041-91111'
+
+BENCHMARKS = ['download', 'verify', 'selfcheck', 'guess', 'flaky', 'resume', 'store', 'stream', 'mirror', 'batch', 'session']
+
+
+def is_probable_prime(value, rng):
+    for prime in [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]:
+        if value % prime == 0:
+            return value == prime
+    odd, shift = value - 1, 0
+    while odd % 2 == 0:
+        odd //= 2
+        shift += 1
+    for _ in range(24):
+        x = pow(rng.randrange(2, value - 1), odd, value)
+        if x in [1, value - 1]:
+            continue
+        for _ in range(shift - 1):
+            x = x * x % value
+            if x == value - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_key(seed=0):
+    """
+    Generate a 2048-bit RSA key (modulus, private exponent) for signing stand-in chunklists.
+    """
+    rng = random.Random(seed)
+    while True:
+        primes = []
+        while len(primes) < 2:
+            candidate = rng.getrandbits(1024) | (3 << 1022) | 1
+            if is_probable_prime(candidate, rng):
+                primes.append(candidate)
+        try:
+            return primes[0] * primes[1], pow(0x10001, -1, (primes[0] - 1) * (primes[1] - 1))
+        except ValueError:
+            continue
+
+
+def build_chunklist(data, chunk_size, key):
+    modulus, exponent = key
+    entries = b''.join(macrecovery.Chunk.pack(len(data[offset:offset + chunk_size]), hashlib.sha256(data[offset:offset + chunk_size]).digest())
+                       for offset in range(0, len(data), chunk_size))
+    count = len(entries) // macrecovery.Chunk.size
+    body = macrecovery.ChunkListHeader.pack(b'CNKL', macrecovery.ChunkListHeader.size, 1, 1, 1, count,
+                                            macrecovery.ChunkListHeader.size, macrecovery.ChunkListHeader.size + len(entries)) + entries
+    signature = pow(macrecovery.CHUNKLIST_SIGNATURE_PADDING | int.from_bytes(hashlib.sha256(body).digest(), 'big'), exponent, modulus)
+    return body + signature.to_bytes(256, 'little')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        return random.random() < self.server.failure_rate
+
+    def reply(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        fail = self.count()
+        if self.path == '/':
+            if fail:
+                return self.reply(503)
+            session = f'session={random.getrandbits(64):016X}'
+            with self.server.lock:
+                self.server.sessions.add(session)
+            return self.reply(200, headers={'Set-Cookie': f'{session}; Path=/; HttpOnly'})
+
+        parts = self.path.split('/')
+        if len(parts) != 4 or parts[1] != 'assets' or parts[3] not in ['BaseSystem.dmg', 'BaseSystem.chunklist']:
+            return self.reply(404)
+        if not self.server.tokens & set(self.headers.get('Cookie', '').split('; ')):
+            return self.reply(403)
+        data = self.server.image if parts[3] == 'BaseSystem.dmg' else self.server.chunklist
+
+        start, end, code = 0, len(data), 200
+        headers = {}
+        if self.headers.get('Range', '').startswith('bytes='):
+            first, _, last = self.headers['Range'][6:].partition('-')
+            start = int(first)
+            end = min(int(last) + 1, len(data)) if last else len(data)
+            code = 206
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{len(data)}'
+
+        self.send_response(code)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        # Injected failures drop the connection half way through the body.
+        stop = start + (end - start) // 2 if fail else end
+        block = 2**16
+        began = time.monotonic()
+        for offset in range(start, stop, block):
+            self.wfile.write(data[offset:min(offset + block, stop)])
+            if self.server.bandwidth > 0:
+                delay = (offset + block - start) / self.server.bandwidth - (time.monotonic() - began)
+                if delay > 0:
+                    time.sleep(delay)
+        self.wfile.flush()
+        if fail:
+            self.close_connection = True
+
+    def do_POST(self):
+        fail = self.count()
+        length = int(self.headers.get('Content-Length', 0))
+        post = dict(line.split('=', 1) for line in self.rfile.read(length).decode('utf-8').split('\n') if '=' in line)
+        if fail:
+            return self.reply(503)
+        if self.path == '/InstallationPayload/Diagnostics':
+            product = PRODUCT_DIAGNOSTICS
+        elif self.path == '/InstallationPayload/RecoveryImage':
+            product = self.server.recovery_product(post.get('bid', ''), post.get('sn', ''), post.get('os', 'default'))
+        else:
+            return self.reply(404)
+        # Like the real server, only sessions it issued are accepted.
+        if not self.server.sessions & set(self.headers.get('Cookie', '').split('; ')):
+            return self.reply(403)
+
+        info = self.server.image_info(product)
+        with self.server.lock:
+            self.server.tokens.update(f'AssetToken={info[key]}' for key in [macrecovery.INFO_IMAGE_SESS, macrecovery.INFO_SIGN_SESS])
+        body = ''.join(f'{key}: {value}\n' for key, value in info.items())
+        self.reply(200, body.encode('utf-8'), {'Content-Type': 'text/plain'})
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local stand-in for osrecovery.apple.com and its asset servers.
+    """
+
+    daemon_threads = True
+    # Concurrent clients open many connections at once, the default backlog of 5 drops some of them.
+    request_queue_size = 128
+
+    def __init__(self, image, chunklist, legacy_boards=(), latency=0, bandwidth=0, failure_rate=0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.image = image
+        self.chunklist = chunklist
+        self.image_hash = hashlib.sha256(image).hexdigest().upper()
+        self.chunklist_hash = hashlib.sha256(chunklist).hexdigest().upper()
+        self.legacy_boards = set(legacy_boards)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sessions = set()
+        self.tokens = set()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def image_info(self, product):
+        """
+        Build image info for product with fresh asset tokens, which are only accepted once issued.
+        """
+        base = f'{self.url}/assets/{product}'
+        return {
+            macrecovery.INFO_PRODUCT: product,
+            macrecovery.INFO_IMAGE_LINK: f'{base}/BaseSystem.dmg',
+            macrecovery.INFO_IMAGE_HASH: self.image_hash,
+            macrecovery.INFO_IMAGE_SESS: f'{random.getrandbits(128):032X}',
+            macrecovery.INFO_SIGN_LINK: f'{base}/BaseSystem.chunklist',
+            macrecovery.INFO_SIGN_HASH: self.chunklist_hash,
+            macrecovery.INFO_SIGN_SESS: f'{random.getrandbits(128):032X}',
+        }
+
+    def recovery_product(self, bid, mlb, os_type):
+        """
+        Follow the server logic described in macrecovery.action_selfcheck.
+        """
+        latest = PRODUCT_LEGACY if bid in self.legacy_boards else PRODUCT_LATEST
+        ppp = mlb[11:15]
+        if len(mlb) != 17 or ppp == '0000' or zlib.crc32((bid + ppp).encode('utf-8')) % 4 != 0:
+            return latest
+        if mlb[:11] != '00000000000':
+            return PRODUCT_OLDEST if os_type == 'default' else latest
+        return PRODUCT_OLDEST
+
+
+def run_cli(*argv):
+    """
+    Run macrecovery.main in process with given arguments, returning exit code and captured output.
+    """
+    # Every run starts with cold connections, like a fresh process would.
+    macrecovery.CONNECTION_POOL = macrecovery.ConnectionPool()
+    macrecovery.QUERY_CACHE = macrecovery.QueryCache()
+    macrecovery.METRICS = macrecovery.Metrics()
+    saved_argv = sys.argv
+    sys.argv = ['macrecovery.py'] + list(argv)
+    output = io.StringIO()
+    try:
+        # Streaming output sends status lines to stderr.
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            code = macrecovery.main()
+    except SystemExit as e:
+        code = e.code
+    finally:
+        sys.argv = saved_argv
+    return code or 0, output.getvalue()
+
+
+def image_mismatch(path, image_hash):
+    """
+    Check that path holds the stand-in image, returning an error message or None.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            digest = hashlib.sha256(fh.read())
+    except OSError as e:
+        return f'Cannot read {path}: {e}'
+    if digest.hexdigest().upper() != image_hash:
+        return f'{path} does not match the image'
+    return None
+
+
+def measure(name, server, rounds, run, size=0, prepare=None, check=None):
+    """
+    Time run over rounds, a round fails on a non-zero exit code or when check returns an error.
+    Preparing a round, e.g. damaging a previous download, is not timed.
+    """
+    timings = []
+    failures = 0
+    requests = 0
+    for _ in range(rounds):
+        if prepare is not None:
+            prepare()
+        before = server.requests
+        start = time.monotonic()
+        code, output = run()
+        timings.append(time.monotonic() - start)
+        requests += server.requests - before
+        error = output.strip().split('\n')[-1] if code != 0 else check() if check is not None else None
+        if error is not None:
+            failures += 1
+            last_error = error
+    result = {
+        'name': name,
+        'rounds': rounds,
+        'failures': failures,
+        'min': min(timings),
+        'mean': sum(timings) / len(timings),
+        'max': max(timings),
+        'requests': requests / rounds,
+    }
+    if size > 0:
+        result['throughput'] = size / result['mean']
+    if failures > 0:
+        result['last_error'] = last_error
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark macrecovery.py against a local stand-in server')
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+                        help=f'benchmarks to run out of {", ".join(BENCHMARKS)}, defaults to all')
+    parser.add_argument('--image-size', type=int, default=64, help='synthetic image size in MBs, defaults to 64')
+    parser.add_argument('--chunk-size', type=int, default=10, help='chunklist chunk size in MBs, defaults to 10')
+    parser.add_argument('--latency', type=float, default=0, help='added latency per request in milliseconds')
+    parser.add_argument('--bandwidth', type=float, default=0, help='per connection bandwidth limit in MBs per second')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests that fail')
+    parser.add_argument('--flaky-rate', type=float, default=0.2,
+                        help='fraction of requests that fail in the flaky benchmark, defaults to 0.2')
+    parser.add_argument('--models', type=int, default=64, help='number of boards to sweep in guess, defaults to 64')
+    parser.add_argument('--rounds', type=int, default=3, help='repeat every benchmark specified number of times, defaults to 3')
+    parser.add_argument('--args', type=str, default='', help='extra arguments passed to every macrecovery.py run')
+    parser.add_argument('--json', type=str, default='', help='write results to specified JSON file')
+    args = parser.parse_args()
+
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            print(f'ERROR: Unknown benchmark {benchmark}!')
+            return 1
+
+    print('Generating synthetic image and signing key...')
+    key = generate_key()
+    image = random.Random(0).randbytes(args.image_size * 2**20)
+    chunklist = build_chunklist(image, args.chunk_size * 2**20, key)
+    boards = {f'Mac-{index:016X}': 'current' if index % 5 else '10.15' for index in range(args.models)}
+    legacy_boards = [board for index, board in enumerate(boards) if index % 7 == 3]
+
+    server = StandInServer(image, chunklist, legacy_boards, args.latency / 1000, args.bandwidth * 2**20, args.failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    saved_server, saved_key = macrecovery.RECOVERY_SERVER, macrecovery.Apple_EFI_ROM_public_key_1
+    macrecovery.RECOVERY_SERVER = server.url
+    macrecovery.Apple_EFI_ROM_public_key_1 = key[0]
+
+    user_args = shlex.split(args.args)
+    extra = user_args + ['--no-cache']
+    workdir = tempfile.mkdtemp(prefix='macrecovery-bench-')
+    results = []
+    mirror = None
+    try:
+        outdir = os.path.join(workdir, 'com.apple.recovery.boot')
+        downloaded = os.path.join(outdir, 'BaseSystem.dmg')
+
+        def clean():
+            shutil.rmtree(outdir, ignore_errors=True)
+
+        def check():
+            return image_mismatch(downloaded, server.image_hash)
+
+        def download():
+            clean()
+            return run_cli('download', '-o', outdir, *extra)
+
+        def verify():
+            return run_cli('check', '-o', outdir, *extra)
+
+        def flaky():
+            # Dropped connections in the middle of segments exercise ranged retries.
+            saved_rate, server.failure_rate = server.failure_rate, args.flaky_rate
+            try:
+                return run_cli('download', '-o', outdir, '-s', '4', '--retries', '8', *extra)
+            finally:
+                server.failure_rate = saved_rate
+
+        def damage():
+            # Leave a truncated download with a corrupted first chunk behind.
+            clean()
+            os.makedirs(outdir)
+            partial = bytearray(image[:len(image) // 2])
+            partial[0] ^= 0xFF
+            with open(downloaded, 'wb') as fh:
+                fh.write(partial)
+
+        def prime_store():
+            clean()
+            if not os.path.isdir(store_dir):
+                run_cli('download', '-o', os.path.join(workdir, 'prime'), '--chunk-store', store_dir, *extra)
+
+        def start_mirror():
+            nonlocal mirror
+            clean()
+            mirror_dir = os.path.join(workdir, 'mirror')
+            shutil.rmtree(mirror_dir, ignore_errors=True)
+            if mirror is None:
+                mirror = ThreadingHTTPServer(('127.0.0.1', 0), macrecovery.MirrorRequestHandler)
+                mirror.daemon_threads = True
+                mirror.verbose = False
+                threading.Thread(target=mirror.serve_forever, daemon=True).start()
+            # Every round starts from an empty mirror, so clients stream the fill from the origin.
+            mirror.mirror = macrecovery.RecoveryMirror(mirror_dir, 2**40)
+
+        def expire_session():
+            # Neither the session nor the asset tokens cached by an earlier run are accepted anymore.
+            clean()
+            key = macrecovery.image_info_key(macrecovery.RECENT_MAC, macrecovery.MLB_ZERO, 'default', False)
+            with open(cache_file, 'w', encoding='utf-8') as fh:
+                json.dump({'session': [time.time(), f'session={random.getrandbits(64):016X}'],
+                           key: [time.time(), server.image_info(PRODUCT_LATEST)]}, fh)
+
+        store_dir = os.path.join(workdir, 'store')
+        stream_path = os.path.join(workdir, 'BaseSystem.dmg')
+        batch_dir = os.path.join(workdir, 'batch')
+        cache_file = os.path.join(workdir, 'queries.json')
+        # The same board with another MLB resolves to another product, which needs a directory of its own.
+        batch_targets = [macrecovery.RECENT_MAC, f'{macrecovery.RECENT_MAC} {macrecovery.MLB_VALID}',
+                         f'{macrecovery.RECENT_MAC} {macrecovery.MLB_VALID} latest', legacy_boards[0] if legacy_boards else next(iter(boards))]
+
+        if 'download' in args.benchmarks:
+            results.append(measure('download', server, args.rounds, download, len(image), check=check))
+        if 'verify' in args.benchmarks:
+            os.makedirs(outdir, exist_ok=True)
+            with open(os.path.join(outdir, 'BaseSystem.dmg'), 'wb') as fh:
+                fh.write(image)
+            with open(os.path.join(outdir, 'BaseSystem.chunklist'), 'wb') as fh:
+                fh.write(chunklist)
+            results.append(measure('verify', server, args.rounds, verify, len(image)))
+        if 'selfcheck' in args.benchmarks:
+            results.append(measure('selfcheck', server, args.rounds, lambda: run_cli('selfcheck', *extra)))
+        if 'guess' in args.benchmarks:
+            board_db = os.path.join(workdir, 'boards.json')
+            with open(board_db, 'w', encoding='utf-8') as fh:
+                json.dump(boards, fh)
+            results.append(measure('guess', server, args.rounds,
+                                   lambda: run_cli('guess', '-m', macrecovery.MLB_VALID, '-db', board_db, *extra)))
+        if 'flaky' in args.benchmarks:
+            results.append(measure('flaky', server, args.rounds, flaky, len(image), clean, check))
+        if 'resume' in args.benchmarks:
+            results.append(measure('resume', server, args.rounds, lambda: run_cli('download', '-o', outdir, '-r', *extra),
+                                   len(image), damage, check))
+        if 'store' in args.benchmarks:
+            results.append(measure('store', server, args.rounds, lambda: run_cli('download', '-o', outdir, '--chunk-store', store_dir, *extra),
+                                   len(image), prime_store, check))
+        if 'stream' in args.benchmarks:
+            results.append(measure('stream', server, args.rounds, lambda: run_cli('download', '-O', stream_path, *extra),
+                                   len(image), check=lambda: image_mismatch(stream_path, server.image_hash)))
+        if 'mirror' in args.benchmarks:
+            results.append(measure('mirror', server, args.rounds,
+                                   lambda: run_cli('download', '-o', outdir, '--mirror', f'http://127.0.0.1:{mirror.server_address[1]}', *extra),
+                                   len(image), start_mirror, check))
+        if 'batch' in args.benchmarks:
+            manifest = os.path.join(workdir, 'manifest.txt')
+            with open(manifest, 'w', encoding='utf-8') as fh:
+                # Repeated targets are only downloaded once.
+                fh.write('\n'.join(batch_targets + batch_targets[:1]) + '\n')
+            expected = sorted(server.recovery_product(*(target.split() + [macrecovery.MLB_ZERO, 'default'][len(target.split()) - 1:])[:3])
+                              for target in batch_targets)
+
+            def check_batch():
+                products = []
+                for name in sorted(os.listdir(batch_dir)):
+                    error = image_mismatch(os.path.join(batch_dir, name, 'BaseSystem.dmg'), server.image_hash)
+                    if error is not None:
+                        return error
+                    with open(os.path.join(batch_dir, name, macrecovery.VERIFIED_NAME), 'r', encoding='utf-8') as fh:
+                        products.append(json.load(fh)['BaseSystem.dmg']['product'])
+                return None if sorted(products) == expected else f'{batch_dir} holds {", ".join(sorted(products))}, expected {", ".join(expected)}'
+
+            results.append(measure('batch', server, args.rounds, lambda: run_cli('batch', '--manifest', manifest, '-o', batch_dir, *extra),
+                                   len(image), lambda: shutil.rmtree(batch_dir, ignore_errors=True), check_batch))
+        if 'session' in args.benchmarks:
+            # Expired sessions and asset tokens cached by an earlier run have to be renewed.
+            results.append(measure('session', server, args.rounds, lambda: run_cli('download', '-o', outdir, '--cache-file', cache_file, *user_args),
+                                   len(image), expire_session, check))
+    finally:
+        macrecovery.RECOVERY_SERVER, macrecovery.Apple_EFI_ROM_public_key_1 = saved_server, saved_key
+        server.shutdown()
+        if mirror is not None:
+            mirror.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        line = (f'{result["name"]:<10} mean {result["mean"]:.3f}s, min {result["min"]:.3f}s, max {result["max"]:.3f}s,'
+                f' {result["requests"]:.1f} requests')
+        if 'throughput' in result:
+            line += f', {result["throughput"] / 2**20:.1f} MB/s'
+        if result['failures'] > 0:
+            line += f', {result["failures"]} of {result["rounds"]} failed ({result["last_error"]})'
+        print(line)
+
+    if args.json != '':
+        with open(args.json, 'w', encoding='utf-8') as fh:
+            json.dump(results, fh, indent=2)
+
+    return 1 if any(result['failures'] > 0 for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())